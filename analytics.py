@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+
+__all__ = ['statement_arrays', 'load_statements', 'effective_apr', 'fee_totals', 'balance_trends',
+           'monthly_deltas']
+
+
+import numpy
+import pandas
+
+MONEY = ['fees', 'interest', 'deposits', 'withdrawals', 'start_balance', 'end_balance']
+DATES = ['start', 'end', 'due']
+
+
+def statement_arrays(storage, user_ids=None, account_ids=None):
+    """ Load statements as a dict of column name to numpy array, one per Statement field
+        plus user_id, reading raw cents and dates and converting each column at once
+        storage - db.Connect to load from
+        user_ids, account_ids - only these users' or accounts' statements, None for all
+    """
+    columns = storage.statement_columns(user_ids, account_ids, raw=True)
+    arrays = {}
+
+    for name, values in columns.items():
+        if name in MONEY:  # cents to dollars, missing amounts become NaN
+            arrays[name] = numpy.array(values, dtype=float) / 100.0
+
+        elif name in DATES:  # missing dates become NaT
+            arrays[name] = numpy.array(values, dtype='datetime64[D]')
+
+        else:
+            arrays[name] = numpy.array(values, dtype=numpy.int64)
+
+    return arrays
+
+
+def load_statements(storage, user_ids=None, account_ids=None):
+    """ Load statements into a DataFrame, one column per Statement field plus user_id
+        storage - db.Connect to load from
+        user_ids, account_ids - only these users' or accounts' statements, None for all
+    """
+    frame = pandas.DataFrame(statement_arrays(storage, user_ids, account_ids))
+
+    for name in DATES:
+        frame[name] = pandas.to_datetime(frame[name])
+
+    return frame
+
+
+def effective_apr(frame, by='account_id'):
+    """ Interest earned (or charged) as an annual percentage of the average balance,
+        weighting each statement by its average balance and the days it covers
+        by - column to group by, 'account_id' or 'user_id'
+    """
+    days = (frame['end'] - frame['start']).dt.days.to_numpy() + 1.0
+    balance_days = (frame['start_balance'] + frame['end_balance']).to_numpy() / 2.0 * days
+    totals = pandas.DataFrame({by: frame[by].to_numpy(),
+                               'interest': frame['interest'].to_numpy(),
+                               'balance_days': balance_days}).groupby(by).sum()
+    balance_days = totals['balance_days'].to_numpy()
+    apr = numpy.divide(totals['interest'].to_numpy() * 365.0 * 100.0, balance_days,
+                       out=numpy.full(len(totals), numpy.nan), where=balance_days != 0)
+    return pandas.Series(apr, index=totals.index, name='apr')
+
+
+def fee_totals(frame, by='account_id'):
+    """ Total fees per account (or user)
+        by - column to group by, 'account_id' or 'user_id'
+    """
+    return frame.groupby(by)['fees'].sum().rename('fees')
+
+
+def balance_trends(frame, by='account_id'):
+    """ Least squares slope of end_balance over time, in dollars per year
+        by - column to group by, 'account_id' or 'user_id'
+    """
+    years = (frame['end'] - pandas.Timestamp('1970-01-01')).dt.days.to_numpy() / 365.25
+    points = pandas.DataFrame({by: frame[by].to_numpy(), 'x': years,
+                               'y': frame['end_balance'].to_numpy()})
+    points['xx'] = points['x'] * points['x']
+    points['xy'] = points['x'] * points['y']
+    sums = points.groupby(by).agg(n=('x', 'size'), x=('x', 'sum'), y=('y', 'sum'),
+                                  xx=('xx', 'sum'), xy=('xy', 'sum'))
+    n = sums['n'].to_numpy()
+    spread = n * sums['xx'].to_numpy() - sums['x'].to_numpy() ** 2
+    slope = numpy.divide(n * sums['xy'].to_numpy() - sums['x'].to_numpy() * sums['y'].to_numpy(),
+                         spread, out=numpy.full(len(sums), numpy.nan),
+                         where=numpy.abs(spread) > 1e-9)
+    return pandas.Series(slope, index=sums.index, name='trend')
+
+
+def monthly_deltas(frame, by='account_id'):
+    """ Month over month change in the balance at the end of each month
+        by - column to group by, 'account_id' or 'user_id'
+        returns a DataFrame of by, month, end_balance and delta (NaN for the first month)
+    """
+    months = pandas.DataFrame({by: frame[by].to_numpy(),
+                               'account_id': frame['account_id'].to_numpy(),
+                               'month': frame['end'].dt.to_period('M'),
+                               'end': frame['end'].to_numpy(),
+                               'end_balance': frame['end_balance'].to_numpy()})
+    # the last statement of each account in a month, summed over the group
+    last = months.sort_values('end').groupby(['account_id', 'month']).tail(1)
+    balances = last.groupby([by, 'month'])['end_balance'].sum().reset_index()
+    balances['delta'] = balances.groupby(by)['end_balance'].diff()
+    return balances
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import analytics
+import db
+import db_test
+import logging
+import math
+import numpy
+
+
+def test_fill_statements(database):
+    user = database.add_user(None, 'analytics@me.com', 'secret')
+    accounts = database.add_accounts([(user['id'], 'savings', 'http://bank.com/',
+                                       'usual login', 'SAVE'),
+                                      (user['id'], 'visa', 'http://bank.com/',
+                                       'usual login', 'CC')])
+    database.add_statements([(accounts[0], '2020/%02d/01'%(m), '2020/%02d/28'%(m), None,
+                              1.00, 2.00, 100.00, 0.00,
+                              1000.00 + 100.00 * (m - 1), 1000.00 + 100.00 * m)
+                             for m in range(1, 7)])
+    database.add_statements([(accounts[1], '2020/%02d/01'%(m), '2020/%02d/28'%(m), None,
+                              0.00, 0.00, 0.00, 0.00, 500.00, 500.00)
+                             for m in range(1, 7)])
+    return user['id'], accounts
+
+
+def test_analytics(database):
+    user_id, accounts = test_fill_statements(database)
+    frame = analytics.load_statements(database, user_ids=[user_id])
+
+    if len(frame) != 12 or set(frame['account_id']) != set(accounts):
+        raise SyntaxError('Expected 12 statements but got:\n' + str(frame))
+
+    arrays = analytics.statement_arrays(database, account_ids=[accounts[0]])
+    columns = database.statement_columns(account_ids=[accounts[0]])
+
+    if (list(arrays['end_balance']) != columns['end_balance']
+        or str(arrays['start'][0]) != '2020-01-01' or arrays['id'].dtype != numpy.int64):
+        raise SyntaxError('raw statement arrays do not match:\n%s\n%s'%(arrays, columns))
+
+    fees = analytics.fee_totals(frame)
+
+    if fees[accounts[0]] != 6.00 or fees[accounts[1]] != 0.00:
+        raise SyntaxError('fee totals are not what we expected:\n' + str(fees))
+
+    if analytics.fee_totals(frame, 'user_id')[user_id] != 6.00:
+        raise SyntaxError('user fee total is not what we expected')
+
+    apr = analytics.effective_apr(frame)
+
+    if not 2.0 < apr[accounts[0]] < 3.0 or apr[accounts[1]] != 0.0:
+        raise SyntaxError('effective APR is not what we expected:\n' + str(apr))
+
+    trends = analytics.balance_trends(frame)
+
+    if not 1100.0 < trends[accounts[0]] < 1300.0 or abs(trends[accounts[1]]) > 1e-6:
+        raise SyntaxError('balance trends are not what we expected:\n' + str(trends))
+
+    deltas = analytics.monthly_deltas(frame, 'user_id')
+
+    if len(deltas) != 6 or not math.isnan(deltas['delta'].iloc[0]):
+        raise SyntaxError('monthly deltas are not what we expected:\n' + str(deltas))
+
+    if list(deltas['delta'].iloc[1:]) != [100.0] * 5:
+        raise SyntaxError('monthly deltas are not what we expected:\n' + str(deltas))
+
+
+def test(url):
+    logging.basicConfig()
+
+    with db.Connect(url) as database:
+        test_analytics(database)
+
+
+if __name__ == '__main__':
+    test(db_test.sqlite_new_file('/tmp/analytics.test.sqlite3'))
@@ -6,27 +6,44 @@ __all__ = ['Connect']
 
 import sqlalchemy
 import sqlalchemy.ext.declarative
+import sqlalchemy.ext.baked
 import threading
+import os
 import queue
+import concurrent.futures
 import logging
 import hashlib
+import hmac
 import traceback
 import datetime
+import time
+import copy
+import collections
+import bisect
+import functools
 
 # TODO: Change user info
 # TODO: Change account info
 
 Alchemy_Base = sqlalchemy.ext.declarative.declarative_base()
 
+DEBT_TYPES = ('CC', 'MORT', 'LOAN')
+PBKDF2_ITERATIONS = 200000
+# SQLite pragmas for an I/O bound server: readers do not block the writer (WAL) and
+# commits only sync at checkpoints, reads are memory mapped with a bigger page cache
+SQLITE_PROFILE = {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                  'mmap_size': 256 * 1024 * 1024, 'cache_size': -64 * 1024,
+                  'busy_timeout': 5000}
+
 
 class Money(sqlalchemy.types.TypeDecorator):
     impl = sqlalchemy.Integer
 
     def process_bind_param(self, value, dialect):
-        return int(value * 100.0 + 0.005)
+        return int(round(value * 100.0))
 
     def process_result_value(self, value, dialect):
-        return value / 100.0
+        return None if None == value else value / 100.0
 
 
 class InterestRate(sqlalchemy.types.TypeDecorator):
@@ -42,14 +59,29 @@ class InterestRate(sqlalchemy.types.TypeDecorator):
 class Date(sqlalchemy.types.TypeDecorator):
     impl = sqlalchemy.types.Date
 
-    def process_bind_param(self, value, dialect):
-        if None == value:
-            return value
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)  # statement dates repeat a lot
+    def parse(text):
+        """ datetime.date of 'YYYY/MM/DD' or ISO 'YYYY-MM-DD' text
+        """
+        if 10 == len(text) and text[4] in '/-' and text[7] == text[4]:
+            return datetime.date(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+
+        if '-' in text:
+            return datetime.datetime.fromisoformat(text).date()
 
-        try:  # if it is a string, parse it, otherwise it must be datetime object
-            return datetime.datetime.strptime(value, "%Y/%m/%d")
-        except TypeError:
-            return value
+        return datetime.datetime.strptime(text, "%Y/%m/%d").date()
+
+    @staticmethod
+    def parse_all(values):
+        """ Date.parse every string of values, other values (dates, None) are kept
+        """
+        parse = Date.parse
+        return [parse(v) if isinstance(v, str) else v for v in values]
+
+    def process_bind_param(self, value, dialect):
+        # if it is a string, parse it, otherwise it must be a date (or datetime) or None
+        return Date.parse(value) if isinstance(value, str) else value
 
     def process_result_value(self, value, dialect):
         return value
@@ -59,9 +91,16 @@ class User(Alchemy_Base):
     __tablename__ = 'user'
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     email = sqlalchemy.Column(sqlalchemy.String(50))
-    password_hash = sqlalchemy.Column(sqlalchemy.String(64))
+    email_normalized = sqlalchemy.Column(sqlalchemy.String(50))
+    password_hash = sqlalchemy.Column(sqlalchemy.String(128))
     birthday = sqlalchemy.Column(Date())
     referrer_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('user.id'))
+    __table_args__ = (sqlalchemy.Index('user_email_normalized', 'email_normalized',
+                                       unique=True),)
+
+    @staticmethod
+    def normalize(email):
+        return email.strip().lower()
 
     @staticmethod
     def hash(text):
@@ -69,6 +108,31 @@ class User(Alchemy_Base):
         hasher.update(text.encode('utf-8'))
         return hasher.hexdigest()
 
+    @staticmethod
+    def pbkdf2_hash(text, iterations=PBKDF2_ITERATIONS):
+        """ 'pbkdf2_sha256$iterations$salt$hash' of text with a new random salt
+        """
+        salt = os.urandom(16).hex()
+        derived = hashlib.pbkdf2_hmac('sha256', text.encode('utf-8'), salt.encode('ascii'),
+                                      iterations)
+        return 'pbkdf2_sha256$%d$%s$%s'%(iterations, salt, derived.hex())
+
+    @staticmethod
+    def verify(text, password_hash):
+        """ Whether text hashes to password_hash, made by pbkdf2_hash or (like the
+            password hashes from before) by hash
+        """
+        if None == password_hash:
+            return False
+
+        if password_hash.startswith('pbkdf2_sha256$'):
+            _, iterations, salt, expected = password_hash.split('$')
+            derived = hashlib.pbkdf2_hmac('sha256', text.encode('utf-8'),
+                                          salt.encode('ascii'), int(iterations))
+            return hmac.compare_digest(derived.hex(), expected)
+
+        return hmac.compare_digest(User.hash(text), password_hash)
+
     def set_password(self, password):
         hasher = hashlib.new('sha256')
         hasher.update(text.encode('utf-8'))
@@ -100,6 +164,7 @@ class Points(Alchemy_Base):
     awarded = sqlalchemy.Column(sqlalchemy.Integer)
     reason = sqlalchemy.Column(sqlalchemy.String(1024))
     when = sqlalchemy.Column(sqlalchemy.DateTime)
+    __table_args__ = (sqlalchemy.Index('points_user_when', 'user_id', 'when'),)
 
     def get_info(self):
         return {'id': self.id, 'user_id': self.user_id, 'awarded': self.awarded,
@@ -111,6 +176,19 @@ class Points(Alchemy_Base):
                                 self.reason)
 
 
+class Point_Balance(Alchemy_Base):
+    __tablename__ = 'point_balance'
+    user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('user.id'),
+                                primary_key=True)
+    balance = sqlalchemy.Column(sqlalchemy.Integer)
+
+    def get_info(self):
+        return {'user_id': self.user_id, 'balance': self.balance}
+
+    def __repr__(self):
+        return 'Point_Balance(user_id=%s, balance=%d)'%(self.user_id, self.balance)
+
+
 class Feedback(Alchemy_Base):
     __tablename__ = 'feedback'
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
@@ -119,6 +197,7 @@ class Feedback(Alchemy_Base):
     type = sqlalchemy.Column(sqlalchemy.String(32))
     subject = sqlalchemy.Column(sqlalchemy.String(1024))
     description = sqlalchemy.Column(sqlalchemy.String(4096))
+    __table_args__ = (sqlalchemy.Index('feedback_user', 'user_id'),)
 
     def get_info(self):
         return {'id': self.id, 'user_id': self.user_id, 'type': self.type,
@@ -145,6 +224,8 @@ class Feedback_Relationship(Alchemy_Base):
                                 sqlalchemy.ForeignKey('feedback.id'))
     to_id = sqlalchemy.Column(sqlalchemy.Integer,
                                 sqlalchemy.ForeignKey('feedback.id'))
+    __table_args__ = (sqlalchemy.Index('feedback_relationship_from', 'from_id'),
+                      sqlalchemy.Index('feedback_relationship_to', 'to_id'))
 
     def get_info(self):
         return {'id': self.id, 'from_type': self.from_type, 'to_type': self.to_type,
@@ -167,6 +248,8 @@ class Feedback_Votes(Alchemy_Base):
     feedback_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('feedback.id'))
     feedback = sqlalchemy.orm.relationship('Feedback', backref='votes')
     votes = sqlalchemy.Column(sqlalchemy.Integer)
+    __table_args__ = (sqlalchemy.Index('feedback_votes_feedback_user',
+                                       'feedback_id', 'user_id'),)
 
     def get_info(self):
         return {'id': self.id, 'user_id': self.user_id, 'feedback_id': self.feedback_id,
@@ -179,6 +262,23 @@ class Feedback_Votes(Alchemy_Base):
                 'votes=%d)')%(self.id, self.user_id, self.feedback_id,self.votes)
 
 
+class Feedback_Tally(Alchemy_Base):
+    __tablename__ = 'feedback_tally'
+    feedback_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('feedback.id'),
+                                    primary_key=True)
+    type = sqlalchemy.Column(sqlalchemy.String(32))
+    votes = sqlalchemy.Column(sqlalchemy.Integer)
+    __table_args__ = (sqlalchemy.Index('feedback_tally_type_votes', 'type', 'votes'),)
+
+    def get_info(self):
+        return {'feedback_id': self.feedback_id, 'type': self.type, 'votes': self.votes}
+
+    def __repr__(self):
+        return ('Feedback_Tally(feedback_id=%s, ' +
+                'type="%s", ' +
+                'votes=%d)')%(self.feedback_id, self.type, self.votes)
+
+
 class Account(Alchemy_Base):
     __tablename__ = 'account'
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
@@ -193,6 +293,7 @@ class Account(Alchemy_Base):
                                  sqlalchemy.ForeignKey('account.id'))
     asset = sqlalchemy.orm.relationship('Account')
     debts = sqlalchemy.orm.relationship('Account', remote_side=[id])
+    __table_args__ = (sqlalchemy.Index('account_user', 'user_id'),)
 
     def get_info(self):
         return {'id': self.id, 'name': self.name, 'url': self.url,
@@ -223,12 +324,14 @@ class Statement(Alchemy_Base):
     account_id = sqlalchemy.Column(sqlalchemy.Integer,
                                    sqlalchemy.ForeignKey('account.id'))
     account = sqlalchemy.orm.relationship("Account", backref="statements")
+    __table_args__ = (sqlalchemy.Index('statement_account_start', 'account_id', 'start'),
+                      sqlalchemy.Index('statement_account_end', 'account_id', 'end'))
 
     def get_info(self):
         return {'id': self.id, 'start': self.start, 'due': self.due,
                 'end': self.end, 'fees': self.fees,
                 'interest': self.interest, 'deposits': self.deposits,
-                'withrawals': self.withrawals,
+                'withdrawals': self.withdrawals,
                 'start_balance': self.start_balance, 'end_balance': self.end_balance,
                 'account_id': self.account_id}
 
@@ -248,15 +351,283 @@ class Statement(Alchemy_Base):
                                  self.account_id)
 
 
-class Connect(threading.Thread):
+class Schema_Version(Alchemy_Base):
+    __tablename__ = 'schema_version'
+    version = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+    applied = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    def __repr__(self):
+        return 'Schema_Version(version=%d, applied="%s")'%(self.version, self.applied)
+
+
+class Lru_Cache:
+    """ Thread safe dictionary keeping only the size most recently used entries
+        entries can expire ttl seconds after they are put (never if ttl is None)
+        and can be tagged so every entry with a tag can be discarded at once
+    """
+
+    def __init__(self, size, ttl=None):
+        self.__size = size
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()  # key to (value, expires, tag)
+        self.__tags = {}  # tag to the set of keys with that tag
+        self.generation = 0  # changes whenever entries are discarded
+        self.hits = 0
+        self.misses = 0
+
+    def __remove(self, key):
+        value, expires, tag = self.__entries.pop(key)
+
+        if None != tag:
+            self.__tags[tag].discard(key)
+
+            if not self.__tags[tag]:
+                del self.__tags[tag]
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+            if None != entry and None != entry[1] and entry[1] < time.monotonic():
+                self.__remove(key)
+                entry = None
+
+            if None == entry:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, tag=None, generation=None):
+        """ generation - the generation when value was read, if anything has been
+                         discarded since then value may be stale and is not kept
+        """
+        with self.__lock:
+            if None != generation and generation != self.generation:
+                return
+
+            if key in self.__entries:
+                self.__remove(key)
+
+            expires = None if None == self.__ttl else time.monotonic() + self.__ttl
+            self.__entries[key] = (value, expires, tag)
+
+            if None != tag:
+                self.__tags.setdefault(tag, set()).add(key)
+
+            while len(self.__entries) > self.__size:
+                self.__remove(next(iter(self.__entries)))
+
+    def discard(self, key):
+        with self.__lock:
+            self.generation += 1
+
+            if key in self.__entries:
+                self.__remove(key)
+
+    def discard_tag(self, tag):
+        with self.__lock:
+            self.generation += 1
+
+            for key in list(self.__tags.get(tag, ())):
+                self.__remove(key)
+
+    def stats(self):
+        with self.__lock:
+            return {'size': len(self.__entries), 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+class Histogram:
+    """ Counts of observed seconds in Prometheus style buckets (not thread safe)
+    """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.BUCKETS) + 1)  # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(Histogram.BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def get_info(self):
+        """ returns {'buckets': [(upper bound, cumulative count)], 'sum':, 'count':}
+        """
+        cumulative = 0
+        buckets = []
+
+        for bound, count in zip(Histogram.BUCKETS + (float('inf'),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+    """ Thread safe timings of commands: time waiting in a queue, time executing,
+        errors and commit latency
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__commands = {}  # name to {'wait': Histogram, 'execute': Histogram, 'errors':}
+        self.__commits = Histogram()
+
+    def observe(self, name, waited, executed, failed=False):
+        with self.__lock:
+            command = self.__commands.get(name)
+
+            if None == command:
+                command = {'wait': Histogram(), 'execute': Histogram(), 'errors': 0}
+                self.__commands[name] = command
+
+            command['wait'].observe(waited)
+            command['execute'].observe(executed)
+            command['errors'] += 1 if failed else 0
+
+    def observe_commit(self, seconds):
+        with self.__lock:
+            self.__commits.observe(seconds)
+
+    def get_info(self):
+        with self.__lock:
+            return {'commands': {name: {'wait': c['wait'].get_info(),
+                                        'execute': c['execute'].get_info(),
+                                        'errors': c['errors']}
+                                 for name, c in self.__commands.items()},
+                    'commit': self.__commits.get_info()}
+
+
+class Feedback_Graph:
+    """ In memory adjacency of Feedback_Relationship rows by from_id and to_id
+    """
+
+    def __init__(self, relationships):
+        """ relationships - Feedback_Relationship info dicts to start with
+        """
+        self.__lock = threading.Lock()
+        self.__edges = {}
+
+        for relationship in relationships:
+            self.add(relationship)
+
+    def add(self, relationship):
+        with self.__lock:
+            for end in (relationship['from_id'], relationship['to_id']):
+                self.__edges.setdefault(end, {})[relationship['id']] = relationship
+
+    def related(self, feedback_id):
+        with self.__lock:
+            return list(self.__edges.get(feedback_id, {}).values())
+
+    def closure(self, feedback_id, relationship_type=None):
+        """ ids of all feedback reachable from feedback_id through relationships
+            (in either direction) of relationship_type, or of any type if None
+        """
+        found = set([feedback_id])
+        frontier = [feedback_id]
 
-    def __init__(self, url):
+        while frontier:
+            reached = [r['to_id'] if r['from_id'] == f else r['from_id']
+                       for f in frontier for r in self.related(f)
+                       if None == relationship_type
+                       or relationship_type in (r['from_type'], r['to_type'])]
+            frontier = [f for f in set(reached) if f not in found]
+            found.update(frontier)
+
+        found.remove(feedback_id)
+        return sorted(found)
+
+
+class Connect(threading.Thread):
+    __MISSING = object()
+
+    def __init__(self, url, workers=0, batch_size=1, batch_linger=0.0,
+                 hasher=User.hash, verifier=User.verify, hash_workers=2,
+                 hash_processes=False,
+                 feedback_index=False, user_cache_size=10000, cache_size=0,
+                 cache_ttl=60.0, sqlite_pragmas=None, session_commands=None,
+                 session_megabytes=None):
+        """ Open the storage on its own thread
+            url - SQLAlchemy url of the database
+            workers - number of extra threads serving read-only commands in parallel,
+                      0 means this thread serves every command
+            batch_size - most queued writes to apply in one transaction (group commit)
+            batch_linger - seconds to wait for more writes to fill a batch
+            hasher - function of a password returning its hash (at most 128 characters)
+                     for new users, like User.pbkdf2_hash (functools.partial of it
+                     for another number of iterations)
+            verifier - function of (password, stored hash) returning whether they match,
+                       it must know the hashes of every hasher used before
+                       hasher and verifier must be module level functions (or partials
+                       of them) when hash_processes is set
+            hash_workers - number of threads (or processes) hashing passwords
+            hash_processes - hash in processes instead of threads, for expensive hashers
+            feedback_index - keep feedback relationships in memory for related lookups
+            user_cache_size - most users to remember the password hash of for logins
+            cache_size - most list_*, tally, points and net worth results to keep,
+                         0 for no cache
+            cache_ttl - seconds to keep cached results, None to keep until written
+            sqlite_pragmas - dict of pragma to value set on every SQLite connection,
+                             like SQLITE_PROFILE, with journal_mode WAL the read
+                             workers get their own read-only (query_only) connections
+            session_commands - start a new session in a worker after this many commands
+                               (1 for a session per command), None to keep it
+            session_megabytes - start a new session in a worker once the process'
+                                resident memory grew by more than this many megabytes
+                                since that session started (growth from the other
+                                threads counts too, /proc has no per thread sizes)
+                                with either, sessions do not expire objects on commit and
+                                drop (expunge) everything loaded after each command
+        """
+        pool = (concurrent.futures.ProcessPoolExecutor if hash_processes
+                else concurrent.futures.ThreadPoolExecutor)
+        self.__hasher = hasher
+        self.__verifier = verifier
+        self.__hashing = pool(max_workers=hash_workers)
         self.__url = url
         self.__running = True
         self.__q = queue.Queue()
+        self.__batch_size = batch_size
+        self.__batch_linger = batch_linger
+        self.__batching = False
+        self.__local = threading.local()
+        self.__feedback_index = feedback_index
+        self.__feedback_graph = None
+        self.__started = threading.Event()
+        self.__failed = None  # exception raised opening the database
+        self.__users = Lru_Cache(user_cache_size)
+        self.__results = Lru_Cache(cache_size, cache_ttl) if cache_size else None
+        self.__metrics = Metrics()
+        self.__bakery = sqlalchemy.ext.baked.bakery()
+        self.__baked_queries = {}
+        self.__workers = 0 if Connect.__is_memory(url) else workers
+        self.__reads = queue.Queue() if self.__workers else self.__q
+        self.__readers = []
+        self.__sqlite_pragmas = sqlite_pragmas or {}
+        self.__read_engine = None
+        self.__read_factory = None
+        self.__session_commands = session_commands
+        self.__session_megabytes = session_megabytes
+        self.__sessions = {}  # worker thread name to its session's sizes
         threading.Thread.__init__(self)
         self.daemon= False
         self.start()
+        self.__started.wait()
+
+        if self.__failed:
+            self.join()
+            self.__hashing.shutdown()
+            raise self.__failed
 
     def __enter__(self):
         """ Start the context (open the storage connection)
@@ -274,76 +645,521 @@ class Connect(threading.Thread):
     def close(self):
         self.__q.put(None)
         self.join()
+        self.__hashing.shutdown()
+
+    @staticmethod
+    def __is_memory(url):
+        url = sqlalchemy.engine.url.make_url(url)
+        return url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:')
+
+    def __engine_options(self):
+        """ Each thread checks out its own connection from a pool sized for all the threads
+        """
+        options = {'pool_size': self.__workers + 1}
+
+        if sqlalchemy.engine.url.make_url(self.__url).drivername.startswith('sqlite'):
+            if Connect.__is_memory(self.__url):
+                return {}
+
+            options['poolclass'] = sqlalchemy.pool.QueuePool
+            options['connect_args'] = {'check_same_thread': False}
+
+        return options
+
+    def __sqlite_engine(self, pragmas):
+        """ An engine setting pragmas (dict of name to value) on each new SQLite connection
+        """
+        engine = sqlalchemy.create_engine(self.__url, **self.__engine_options())
+
+        def connected(connection, record):
+            cursor = connection.cursor()
+
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA %s=%s'%(name, value))
+
+            cursor.close()
+
+        if pragmas and engine.dialect.name == 'sqlite':
+            sqlalchemy.event.listen(engine, 'connect', connected)
+
+        return engine
 
     def __init(self):
-        engine = sqlalchemy.create_engine(self.__url)
-        factory = sqlalchemy.orm.sessionmaker(bind=engine)
-        Session = sqlalchemy.orm.scoped_session(factory)
-        self.__session = Session()
+        engine = self.__sqlite_engine(self.__sqlite_pragmas)
+        factory = sqlalchemy.orm.sessionmaker(bind=engine,
+                                              expire_on_commit=not self.__session_policy())
+        # scoped_session gives every worker thread its own session
+        self.__session = sqlalchemy.orm.scoped_session(factory)
         Alchemy_Base.metadata.create_all(engine)
+        self.__migrate(engine)
+
+        if self.__feedback_index:
+            self.__feedback_graph = Feedback_Graph(
+                [r.get_info() for r in self.__session.query(Feedback_Relationship)])
+            self.__session.rollback()
+
+        wal = 'WAL' == str(self.__sqlite_pragmas.get('journal_mode', '')).upper()
+
+        if self.__workers and wal and engine.dialect.name == 'sqlite':
+            pragmas = dict(self.__sqlite_pragmas, query_only='ON')
+            del pragmas['journal_mode']  # already set on the database file by the writer
+            self.__read_engine = self.__sqlite_engine(pragmas)
+            self.__read_factory = sqlalchemy.orm.sessionmaker(
+                bind=self.__read_engine, expire_on_commit=not self.__session_policy())
+
         return engine
 
+    def __submit(self, commands, function, *args):
+        """ Queue a command for a worker thread, the returned Future gets the result
+        """
+        results = concurrent.futures.Future()
+        commands.put((function, results, time.monotonic()) + args)
+        return results
+
+    def metrics(self):
+        """ Timings of every command run so far (by command name) and of commits
+            plus the number of commands waiting in the write and read queues
+        """
+        info = self.__metrics.get_info()
+        info['queue_depth'] = {'writes': self.__q.qsize(),
+                               'reads': self.__reads.qsize() if self.__workers else 0}
+        info['sessions'] = dict(self.__sessions)
+        info['resident_megabytes'] = Connect.__resident_megabytes()
+        return info
+
+    @staticmethod
+    def __resident_megabytes():
+        """ Resident memory of this process, None where /proc is not available
+        """
+        try:
+            with open('/proc/self/statm') as statm:
+                pages = int(statm.read().split()[1])
+
+        except (OSError, IndexError, ValueError):
+            return None
+
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+
+    @staticmethod
+    def __command_name(command):
+        return command[0].__name__.lstrip('_')
+
+    def __cached(self, tag, key, submit):
+        """ A Future for the cached result for key, on a miss submit() the command
+            and cache its result under tag (unless a write to tag happened meanwhile)
+        """
+        if None == self.__results:
+            return submit()
+
+        found = self.__results.get(key, Connect.__MISSING)
+
+        if found is not Connect.__MISSING:
+            results = concurrent.futures.Future()
+            results.set_result(copy.deepcopy(found))
+            return results
+
+        generation = self.__results.generation
+
+        def remember(value):
+            self.__results.put(key, value, tag, generation)
+            return copy.deepcopy(value)
+
+        return Connect.__then(submit(), remember)
+
+    def __forget(self, *tags):
+        """ Once the current command commits, drop the cached results of these tags
+        """
+        if None != self.__results:
+            self.__after_commit(lambda: [self.__results.discard_tag(t) for t in tags])
+
+    def cache_stats(self):
+        """ Sizes, hits and misses of the result cache (None if off) and the login cache
+        """
+        return {'results': None if None == self.__results else self.__results.stats(),
+                'users': self.__users.stats()}
+
+    @staticmethod
+    def __then(future, next):
+        """ A Future for next(result of future), next may return a value or another Future
+            error results (tuples) pass straight through without calling next
+        """
+        results = concurrent.futures.Future()
+
+        def finish(done, next=lambda value: value):
+            try:
+                value = done.result()
+
+                if not isinstance(value, tuple):
+                    value = next(value)
+
+            except:
+                logging.error(traceback.format_exc())
+                value = (traceback.format_exc(),)
+
+            if isinstance(value, concurrent.futures.Future):
+                value.add_done_callback(finish)
+
+            else:
+                results.set_result(value)
+
+        future.add_done_callback(lambda done: finish(done, next))
+        return results
+
+    def __after_commit(self, action):
+        """ Run action once the current command (or batch) has been committed
+        """
+        self.__local.committed = getattr(self.__local, 'committed', []) + [action]
+
+    def __committed(self, succeeded):
+        actions = getattr(self.__local, 'committed', [])
+        self.__local.committed = []
+
+        for action in actions if succeeded else []:
+            action()
+
+    def __commit(self):
+        """ Commit unless a batch of writes is being applied, the batch commits at its end
+        """
+        if self.__batching:
+            self.__session.flush()
+
+        else:
+            started = time.monotonic()
+            self.__session.commit()
+            self.__metrics.observe_commit(time.monotonic() - started)
+
     def __add(self, object):
         self.__session.add(object)
-        self.__session.commit()
+        self.__commit()
         return object
 
+    @staticmethod
+    def __mappings(rows, fields, defaults={}):
+        """ Rows of dicts, or tuples in the order of fields, as dicts for bulk inserts
+        """
+        return [dict(defaults, **(row if isinstance(row, dict) else dict(zip(fields, row))))
+                for row in rows]
+
+    def __add_all(self, cls, mappings):
+        """ Insert many rows in one transaction with one executemany, returning their ids
+            the ids follow max(id) read in the same transaction, this thread being the
+            only writer (drivers do not return the ids of an executemany)
+        """
+        if not mappings:
+            return []
+
+        first = (self.__session.query(sqlalchemy.func.max(cls.id)).scalar() or 0) + 1
+
+        for id, mapping in enumerate(mappings, first):
+            mapping['id'] = id
+
+        self.__session.execute(cls.__table__.insert(), mappings)
+        self.__commit()
+        return [m['id'] for m in mappings]
+
+    @staticmethod
+    def __cursor(row, order):
+        """ The values of row's order columns as text, NULL as an empty value
+        """
+        values = [getattr(row, c.key) for c in order]
+        return ','.join(['' if None == v else str(v) if isinstance(v, int)
+                         else v.isoformat() for v in values])
+
+    @staticmethod
+    def __cursor_values(cursor, order):
+        values = cursor.split(',')
+        return [None if '' == v
+                else datetime.datetime.fromisoformat(v)
+                if isinstance(c.type, sqlalchemy.DateTime)
+                else datetime.date.fromisoformat(v) if isinstance(c.type, Date)
+                else int(v) for c, v in zip(order, values)]
+
+    @staticmethod
+    def __seek(order, values, descending):
+        """ Filter for the rows past values (bindparams, which may be NULL) in the order
+            of the order columns, NULLs sorting first as SQLite and MySQL sort them
+        """
+        condition = None
+
+        for column, value in reversed(list(zip(order, values))):
+            past = column < value if descending else column > value
+            same = column == value
+
+            if column.nullable:
+                past = sqlalchemy.or_(past, sqlalchemy.and_(
+                    column.is_(None) if descending else column.isnot(None),
+                    value.isnot(None) if descending else value.is_(None)))
+                same = sqlalchemy.or_(same, sqlalchemy.and_(column.is_(None),
+                                                           value.is_(None)))
+
+            condition = past if condition is None else sqlalchemy.or_(
+                past, sqlalchemy.and_(same, condition))
+
+        return condition
+
+    def __page(self, query, order, limit, after, info, descending=False):
+        """ Keyset (seek) pagination of query by the order columns, the last must be unique
+            limit - most rows in the page, None for a list of every row (no page)
+            after - the 'next' cursor of the previous page, None for the first page
+            info - function turning a row into the dict to return
+            returns {'results': list of info, 'next': cursor or None after the last page}
+        """
+        if None == limit:
+            return [info(x) for x in query]
+
+        if None != after:
+            values = Connect.__cursor_values(after, order)
+            query = query.filter(Connect.__seek(order, [
+                sqlalchemy.bindparam(None, v, type_=c.type) for c, v in zip(order, values)],
+                descending))
+
+        order_by = [c.desc() for c in order] if descending else order
+        return Connect.__paged(query.order_by(*order_by).limit(limit + 1).all(), order,
+                               limit, info)
+
+    @staticmethod
+    def __paged(found, order, limit, info):
+        """ The page of the (up to limit + 1) rows found
+        """
+        more = len(found) > limit
+        found = found[:limit]
+        return {'results': [info(x) for x in found],
+                'next': Connect.__cursor(found[-1], order) if more else None}
+
+    def __baked(self, key, query, *criteria):
+        """ The query for key in this thread's session, built by query(session) then
+            each of criteria(query) and compiled only the first time it is used
+            query and criteria may only vary by sqlalchemy.bindparam values, set by params
+        """
+        baked = self.__baked_queries.get(key)
+
+        if None == baked:
+            baked = self.__bakery(query, key)
+
+            for criterion in criteria:
+                baked += criterion
+
+            self.__baked_queries[key] = baked
+
+        return baked(self.__session())
+
+    def __baked_page(self, key, query, params, order, limit, after, info,
+                     descending=False):
+        """ __page of the baked query(session) filtered by bindparams set from params
+        """
+        if None == limit:
+            return [info(x) for x in self.__baked((key, 'all'), query).params(**params)]
+
+        order_by = [c.desc() for c in order] if descending else order
+        limited = lambda q: q.order_by(*order_by).limit(sqlalchemy.bindparam('limit'))
+
+        if None == after:
+            found = self.__baked((key, 'first', descending), query, limited)
+
+        else:
+            seek = lambda q: q.filter(Connect.__seek(
+                order, [sqlalchemy.bindparam('after_%d'%(n), type_=c.type)
+                        for n, c in enumerate(order)], descending))
+            found = self.__baked((key, 'after', descending), query, seek, limited)
+            values = Connect.__cursor_values(after, order)
+            params = dict(params, **{'after_%d'%(n): v for n, v in enumerate(values)})
+
+        return Connect.__paged(found.params(limit=limit + 1, **params).all(), order,
+                               limit, info)
+
+    @staticmethod
+    def __check_limit(limit):
+        if None != limit and limit < 1:
+            raise ValueError('limit must be at least 1: ' + str(limit))
+
+    def __iterate(self, page, chunk):
+        """ Generator of the results of the keyset pages page(limit, after), chunk rows
+            at a time, each page is its own read so no worker is held between pages
+        """
+        after = None
+
+        while True:
+            found = page(chunk, after)
+
+            if isinstance(found, tuple):
+                raise RuntimeError(found[0])
+
+            yield from found['results']
+            after = found['next']
+
+            if not after:
+                return
+
+    def __migrate(self, engine):
+        """ Bring databases from before up to date, applying each numbered migration once
+            create_all only adds missing tables, so columns and indexes added to
+            existing tables need a migration. Migrations must check what is already
+            there since new databases get everything from create_all.
+            Only ever append to migrations.
+        """
+        migrations = [self.__add_normalized_email,
+                      self.__add_missing_tallies,
+                      self.__add_missing_balances,
+                      self.__add_missing_indexes,
+                      self.__widen_password_hash]
+        applied = self.__session.query(sqlalchemy.func.max(Schema_Version.version)
+                                       ).scalar() or 0
+
+        for version in range(applied + 1, len(migrations) + 1):
+            logging.info('migrating database to version %d'%(version))
+            migrations[version - 1](engine)
+            self.__session.add(Schema_Version(version=version,
+                                              applied=datetime.datetime.now()))
+            self.__session.commit()
+
+    def __add_missing_indexes(self, engine):
+        """ Create the declared indexes missing from tables created before them
+        """
+        inspector = sqlalchemy.inspect(engine)
+
+        for table in Alchemy_Base.metadata.sorted_tables:
+            existing = [i['name'] for i in inspector.get_indexes(table.name)]
+
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=engine)
+
+    def __widen_password_hash(self, engine):
+        """ Make user.password_hash from before long enough for salted hashes
+            (SQLite does not limit the length of strings)
+        """
+        if 'sqlite' == engine.dialect.name:
+            return
+
+        quote = engine.dialect.identifier_preparer.quote
+        column = User.__table__.c.password_hash
+        change = 'MODIFY' if 'mysql' == engine.dialect.name else 'ALTER COLUMN'
+        self.__session.execute('ALTER TABLE %s %s %s %s%s'%(
+            quote(User.__tablename__), change, quote(column.name),
+            '' if 'mysql' == engine.dialect.name else 'TYPE ',
+            column.type.compile(dialect=engine.dialect)))
+        self.__session.commit()
+
+    def __add_normalized_email(self, engine):
+        """ Add, fill in and uniquely index user.email_normalized in databases from before
+        """
+        columns = sqlalchemy.inspect(engine).get_columns(User.__tablename__)
+
+        if 'email_normalized' in [c['name'] for c in columns]:
+            return
+
+        quote = engine.dialect.identifier_preparer.quote
+        column = User.__table__.c.email_normalized
+        self.__session.execute('ALTER TABLE %s ADD COLUMN %s %s'%(
+            quote(User.__tablename__), quote(column.name),
+            column.type.compile(dialect=engine.dialect)))
+        self.__session.execute(User.__table__.update().values(
+            email_normalized=sqlalchemy.func.lower(sqlalchemy.func.trim(User.email))))
+        self.__unnormalize_colliding_emails()
+        self.__session.commit()
+
+        for index in User.__table__.indexes:
+            index.create(bind=engine)
+
+    def __unnormalize_colliding_emails(self):
+        """ Users from before whose emails only differ by case or spaces can not share
+            the uniquely indexed email_normalized, the lowest id keeps it and the rest
+            are left without one (so they can not log in) and logged to be merged
+        """
+        colliding = self.__session.query(
+            User.email_normalized, sqlalchemy.func.min(User.id)).group_by(
+            User.email_normalized).having(sqlalchemy.func.count(User.id) > 1).all()
+
+        for email_normalized, kept in colliding:
+            others = self.__session.query(User.id, User.email).filter(
+                User.email_normalized == email_normalized, User.id != kept).all()
+            logging.warning('users %s have the same email as user %d (%s), they can '
+                            'not log in until merged'%(
+                            ', '.join('%d (%s)'%(i, e) for i, e in others), kept,
+                            email_normalized))
+            self.__session.execute(User.__table__.update().where(
+                User.id.in_([i for i, _ in others])).values(email_normalized=None))
+
     def __find_user(self, email):
-        return self.__session.query(User).filter(sqlalchemy.func.lower(User.email)
-                                                 == sqlalchemy.func.lower(email)
-                                                 ).one_or_none()
+        found = self.__baked('find_user', lambda s: s.query(User).filter(
+                                 User.email_normalized == sqlalchemy.bindparam('email')))
+        return found.params(email=User.normalize(email)).one_or_none()
 
-    def __add_user(self, referrer_id, email, password):
+    def __add_user(self, referrer_id, email, password_hash):
         user = self.__find_user(email=email)
 
         if user:
             return ({'id': None, 'valid': False})
 
         else:
-            password_hash = password_hash=User.hash(password)
             user = self.__add(User(email=email, referrer_id=referrer_id,
+                                   email_normalized=User.normalize(email),
                                    password_hash=password_hash))
+            self.__after_commit(lambda: self.__users.discard(User.normalize(email)))
             return ({'id': user.id,
                      'referrer_id': user.referrer_id,
                      'email': email,
                      'valid': True})
 
+    def add_user_async(self, referrer_id, email, password):
+        hashed = self.__hashing.submit(self.__hasher, password)
+        return Connect.__then(hashed, lambda password_hash: self.__submit(
+            self.__q, self.__add_user, referrer_id, email, password_hash))
+
     def add_user(self, referrer_id, email, password):
-        results = queue.Queue()
-        self.__q.put((self.__add_user, results, referrer_id, email, password))
-        return results.get()
+        return self.add_user_async(referrer_id, email, password).result()
 
     def __set_user_birthday(self, user_id, birthday):
-        user = self.__find_user(id=user_id)
+        user = self.__session.query(User).get(user_id)
 
         if user:
-            user.birthday = birthday
+            user.birthday = Date.parse(birthday) if isinstance(birthday, str) else birthday
+            self.__commit()
+            self.__after_commit(lambda: self.__users.discard(user.email_normalized))
             return user.get_info()
 
         return {'id': user_id, 'valid': False, 'birthday': birthday}
 
+    def set_user_birthday_async(self, user_id, birthday):
+        return self.__submit(self.__q, self.__set_user_birthday, user_id, birthday)
+
     def set_user_birthday(self, user_id, birthday):
-        results = queue.Queue()
-        self.__q.put((self.__set_user_birthday, results, user_id, birthday))
-        return results.get()
+        return self.set_user_birthday_async(user_id, birthday).result()
 
-    def __login_user(self, email, password):
+    def __find_password_hash(self, email):
         user = self.__find_user(email=email)
 
+        if not user:
+            return None
+
+        found = {'id': user.id, 'password_hash': user.password_hash}
+        self.__users.put(user.email_normalized, found)
+        return found
+
+    def __check_password(self, email, password, user):
         if not user:
             return ({'id': None,
                             'email': email,
                             'valid': False})
 
-        else:
-            return ({'id': user.id,
-                            'email': email,
-                            'valid': user.password_matches(password)})
+        verified = self.__hashing.submit(self.__verifier, password, user['password_hash'])
+        return Connect.__then(verified, lambda valid: {'id': user['id'],
+                                                       'email': email,
+                                                       'valid': valid})
+
+    def login_user_async(self, email, password):
+        user = self.__users.get(User.normalize(email))
+
+        if user:
+            return self.__check_password(email, password, user)
+
+        found = self.__submit(self.__reads, self.__find_password_hash, email)
+        return Connect.__then(found, lambda user: self.__check_password(email,
+                                                                        password,
+                                                                        user))
 
     def login_user(self, email, password):
-        results = queue.Queue()
-        self.__q.put((self.__login_user, results, email, password))
-        return results.get()
+        return self.login_user_async(email, password).result()
 
     def __add_account(self, user_id, name, url, info, type, interest_rate, asset_id):
         info = {'name': name, 'url': url, 'info': info, 'type': type,
@@ -351,28 +1167,56 @@ class Connect(threading.Thread):
                 'asset_id': asset_id}
         account = self.__add(Account(**info))
         info['id'] = account.id
+        self.__forget(('accounts', user_id), ('net_worth', user_id))
         return info
 
+    def add_account_async(self, user_id, name, url, info, type, interest_rate=0.0,
+                          asset_id=None):
+        return self.__submit(self.__q, self.__add_account, user_id, name, url, info,
+                             type, interest_rate, asset_id)
+
     def add_account(self, user_id, name, url, info, type, interest_rate=0.0,
                     asset_id=None):
-        results = queue.Queue()
-        self.__q.put((self.__add_account, results, user_id, name, url, info,
-                      type, interest_rate, asset_id))
-        return results.get()
-
-    def __list_accounts(self, user_id):
-        found = self.__session.query(Account).filter_by(user_id
-                                                        =user_id).all()
-        return [{'name': a.name, 'url': a.url, 'info': a.info,
-                         'type': a.type, 'user_id': a.user_id,
-                         'interest_rate': a.interest_rate,
-                         'asset_id': a.asset_id, 'id': a.id}
-                        for a in found]
-
-    def list_accounts(self, user_id):
-        results = queue.Queue()
-        self.__q.put((self.__list_accounts, results, user_id))
-        return results.get()
+        return self.add_account_async(user_id, name, url, info, type, interest_rate,
+                                      asset_id).result()
+
+    def __add_accounts(self, rows):
+        fields = ('user_id', 'name', 'url', 'info', 'type', 'interest_rate', 'asset_id')
+        accounts = Connect.__mappings(rows, fields, {'interest_rate': 0.0})
+        user_ids = set([a['user_id'] for a in accounts])
+        self.__forget(*[t for u in user_ids for t in (('accounts', u), ('net_worth', u))])
+        return self.__add_all(Account, accounts)
+
+    def add_accounts_async(self, rows):
+        return self.__submit(self.__q, self.__add_accounts, rows)
+
+    def add_accounts(self, rows):
+        """ Add many accounts in one transaction
+            rows - dicts or tuples in the order of add_account arguments
+            returns the new account ids in the order of rows
+        """
+        return self.add_accounts_async(rows).result()
+
+    def __list_accounts(self, user_id, limit, after):
+        return self.__baked_page('list_accounts', lambda s: s.query(Account).filter(
+                                     Account.user_id == sqlalchemy.bindparam('user_id')),
+                                 {'user_id': user_id}, (Account.id,), limit, after,
+                                 lambda a: {'name': a.name, 'url': a.url, 'info': a.info,
+                                      'type': a.type, 'user_id': a.user_id,
+                                      'interest_rate': a.interest_rate,
+                                      'asset_id': a.asset_id, 'id': a.id})
+
+    def list_accounts_async(self, user_id, limit=None, after=None):
+        Connect.__check_limit(limit)
+
+        return self.__cached(('accounts', user_id), ('list_accounts', user_id, limit, after),
+                             lambda: self.__submit(self.__reads, self.__list_accounts,
+                                                   user_id, limit, after))
+
+    def list_accounts(self, user_id, limit=None, after=None):
+        """ The user's accounts, a page of limit of them (by id) if limit is given
+        """
+        return self.list_accounts_async(user_id, limit, after).result()
 
     def __add_statement(self, account_id, start, end, due,
                       fees, interest, deposits, withdrawals,
@@ -384,161 +1228,823 @@ class Connect(threading.Thread):
                 'start_balance': start_balance,  'end_balance': end_balance}
         statement = self.__add(Statement(**info))
         info['id'] = statement.id
+        self.__forget_net_worth([account_id])
+        self.__forget(('statements', account_id))
         return info
 
+    def add_statement_async(self, account_id, start, end, due,
+                            fees, interest, deposits, withdrawals,
+                            start_balance, end_balance):
+        return self.__submit(self.__q, self.__add_statement, account_id,  start, end, due,
+                             fees, interest, deposits, withdrawals,
+                             start_balance, end_balance)
+
     def add_statement(self, account_id, start, end, due,
                       fees, interest, deposits, withdrawals,
                       start_balance, end_balance):
-        results = queue.Queue()
-        self.__q.put((self.__add_statement, results, account_id,  start, end, due,
-                      fees, interest, deposits, withdrawals,
-                      start_balance, end_balance))
-        return results.get()
-
-    def __list_statements(self, account_id):
-        found = self.__session.query(Statement).filter_by(account_id
-                                                        =account_id).all()
-        return [{'account_id': s.account_id,
-                         'start': s.start, 'end': s.end, 'due': s.due,
-                         'fees': s.fees, 'interest': s.interest,
-                         'deposits': s.deposits,
-                         'withdrawals': s.withdrawals,
-                         'start_balance': s.start_balance,
-                         'end_balance': s.end_balance,
-                         'id': s.id}
-                        for s in found]
-
-    def list_statements(self, account_id):
-        results = queue.Queue()
-        self.__q.put((self.__list_statements, results, account_id))
-        return results.get()
+        return self.add_statement_async(account_id, start, end, due,
+                                        fees, interest, deposits, withdrawals,
+                                        start_balance, end_balance).result()
+
+    def __add_statements(self, rows):
+        fields = ('account_id', 'start', 'end', 'due', 'fees', 'interest',
+                  'deposits', 'withdrawals', 'start_balance', 'end_balance')
+        statements = Connect.__mappings(rows, fields)
+        account_ids = set([s['account_id'] for s in statements])
+
+        for field in ('start', 'end', 'due'):
+            for statement, date in zip(statements, Date.parse_all([s[field]
+                                                                   for s in statements])):
+                statement[field] = date
+
+        self.__forget_net_worth(account_ids)
+        self.__forget(*[('statements', a) for a in account_ids])
+        return self.__add_all(Statement, statements)
+
+    def add_statements_async(self, rows):
+        return self.__submit(self.__q, self.__add_statements, rows)
+
+    def add_statements(self, rows):
+        """ Add many statements in one transaction
+            rows - dicts or tuples in the order of add_statement arguments
+            returns the new statement ids in the order of rows
+        """
+        return self.add_statements_async(rows).result()
+
+    def __list_statements(self, account_id, limit, after):
+        return self.__baked_page('list_statements', lambda s: s.query(Statement).filter(
+                                     Statement.account_id
+                                     == sqlalchemy.bindparam('account_id')),
+                                 {'account_id': account_id},
+                                 (Statement.start, Statement.id), limit, after,
+                                 lambda s: s.get_info())
+
+    def list_statements_async(self, account_id, limit=None, after=None):
+        Connect.__check_limit(limit)
+
+        return self.__cached(('statements', account_id),
+                             ('list_statements', account_id, limit, after),
+                             lambda: self.__submit(self.__reads, self.__list_statements,
+                                                   account_id, limit, after))
+
+    def list_statements(self, account_id, limit=None, after=None):
+        """ The account's statements, a page of limit of them (by start) if limit is given
+        """
+        return self.list_statements_async(account_id, limit, after).result()
+
+    def __statement_columns(self, user_ids, account_ids, raw):
+        columns = [c for c in Statement.__table__.columns] + [Account.user_id]
+        query = sqlalchemy.select(columns).select_from(
+            Statement.__table__.join(Account.__table__,
+                                     Statement.account_id == Account.id))
+
+        if None != user_ids:
+            query = query.where(Account.user_id.in_(user_ids))
+
+        if None != account_ids:
+            query = query.where(Statement.account_id.in_(account_ids))
+
+        found = self.__session.execute(query.order_by(Statement.account_id,
+                                                      Statement.start))
+
+        if raw:  # rows straight from the driver, skipping every Money and Date conversion
+            rows = found.cursor.fetchall()
+            found.close()
+
+        else:
+            rows = found.fetchall()
+
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        return {c.key: list(v) for c, v in zip(columns, values)}
+
+    def statement_columns_async(self, user_ids=None, account_ids=None, raw=False):
+        return self.__submit(self.__reads, self.__statement_columns, user_ids, account_ids,
+                             raw)
+
+    def statement_columns(self, user_ids=None, account_ids=None, raw=False):
+        """ Statements (with their account's user_id) as a dict of column name to a list
+            of values, ordered by account and start, for loading into columnar arrays
+            user_ids, account_ids - only these users' or accounts' statements, None for all
+            raw - values as stored, Money in integer cents and dates as the driver returns
+                  them (ISO strings on SQLite), to be converted a whole column at a time
+        """
+        return self.statement_columns_async(user_ids, account_ids, raw).result()
+
+    def __net_worth_of(self, user_id, as_of):
+        latest = self.__session.query(Statement.account_id,
+                                      sqlalchemy.func.max(Statement.end).label('end')
+                                      ).join(Account, Statement.account_id == Account.id
+                                      ).filter(Account.user_id == user_id)
+
+        if None != as_of:
+            latest = latest.filter(Statement.end <= as_of)
+
+        latest = latest.group_by(Statement.account_id).subquery()
+        found = self.__session.query(Account.id, Account.type, Account.asset_id,
+                                     Statement.end_balance
+                                     ).outerjoin(latest, latest.c.account_id == Account.id
+                                     ).outerjoin(Statement, sqlalchemy.and_(
+                                         Statement.account_id == latest.c.account_id,
+                                         Statement.end == latest.c.end)
+                                     ).filter(Account.user_id == user_id)
+        accounts = {}
+
+        for id, type, asset_id, balance in found:
+            accounts[id] = {'id': id, 'type': type, 'asset_id': asset_id,
+                            'balance': balance if balance else 0.0,
+                            'debt': None != asset_id or type in DEBT_TYPES}
+
+        assets = [a for a in accounts.values() if not a['debt']]
+        debts = [a for a in accounts.values() if a['debt']]
+
+        for asset in assets:
+            asset['debts'] = sum([d['balance'] for d in debts if d['asset_id'] == asset['id']])
+            asset['equity'] = asset['balance'] - asset['debts']
+
+        total_assets = sum([a['balance'] for a in assets])
+        total_debts = sum([d['balance'] for d in debts])
+        return {'user_id': user_id, 'as_of': as_of,
+                'assets': total_assets, 'debts': total_debts,
+                'net_worth': total_assets - total_debts,
+                'accounts': sorted(accounts.values(), key=lambda a: a['id'])}
+
+    def __forget_net_worth(self, account_ids):
+        """ Once the current command commits, drop the cached net worth of the users
+            owning these accounts
+        """
+        if None != self.__results:
+            owners = self.__session.query(Account.user_id).filter(
+                Account.id.in_(account_ids)).distinct()
+            self.__forget(*[('net_worth', u) for u, in owners])
+
+    def net_worth_async(self, user_id, as_of=None):
+        return self.__cached(('net_worth', user_id), ('net_worth', user_id, as_of),
+                             lambda: self.__submit(self.__reads, self.__net_worth_of,
+                                                   user_id, as_of))
+
+    def net_worth(self, user_id, as_of=None):
+        """ The user's assets less their debts, from the latest statement of each account
+            (on or before as_of if given). Debts are accounts linked to an asset
+            (like a mortgage to a house) or of a DEBT_TYPES type, their balance is owed.
+            Cached (with cache_size) until one of their accounts or statements is added.
+            returns totals and each account's balance, assets also get their linked debts
+            and equity
+        """
+        return self.net_worth_async(user_id, as_of).result()
+
+    def iter_statements(self, account_id, chunk=1000):
+        """ Generator of all the account's statements (by start) read chunk at a time
+            (pages skip the result cache)
+        """
+        Connect.__check_limit(chunk)
+        return self.__iterate(lambda limit, after: self.__submit(
+                                  self.__reads, self.__list_statements, account_id, limit,
+                                  after).result(), chunk)
 
     def __add_feedback(self, user_id, type, subject, description):
         info = {'user_id': user_id, 'type': type, 'subject': subject, 'description': description}
-        statement = self.__add(Feedback(**info))
+        statement = Feedback(**info)
+        self.__session.add(statement)
+        self.__session.flush()
+        self.__add(Feedback_Tally(feedback_id=statement.id, type=type, votes=0))
+        self.__forget(('feedback', user_id), ('top_feedback',))
         info['id'] = statement.id
         return info
 
+    def add_feedback_async(self, user_id, type, subject, description):
+        return self.__submit(self.__q, self.__add_feedback, user_id, type, subject,
+                             description)
+
     def add_feedback(self, user_id, type, subject, description):
-        results = queue.Queue()
-        self.__q.put((self.__add_feedback, results, user_id, type, subject, description))
-        return results.get()
+        return self.add_feedback_async(user_id, type, subject, description).result()
 
-    def __list_feedback(self, user_id):
+    def __list_feedback(self, user_id, limit, after):
         found = self.__session.query(Feedback).filter_by(user_id
-                                                        =user_id).all()
-        return [{'user_id': s.user_id,
-                 'type': s.type, 'subject': s.subject, 'description': s.description,
-                 'id': s.id}
-                for s in found]
-
-    def list_feedback(self, user_id):
-        results = queue.Queue()
-        self.__q.put((self.__list_feedback, results, user_id))
-        return results.get()
+                                                        =user_id)
+        return self.__page(found, (Feedback.id,), limit, after,
+                           lambda s: {'user_id': s.user_id,
+                                      'type': s.type, 'subject': s.subject,
+                                      'description': s.description,
+                                      'id': s.id})
+
+    def list_feedback_async(self, user_id, limit=None, after=None):
+        Connect.__check_limit(limit)
+
+        return self.__cached(('feedback', user_id), ('list_feedback', user_id, limit, after),
+                             lambda: self.__submit(self.__reads, self.__list_feedback,
+                                                   user_id, limit, after))
+
+    def list_feedback(self, user_id, limit=None, after=None):
+        """ The user's feedback, a page of limit of them (by id) if limit is given
+        """
+        return self.list_feedback_async(user_id, limit, after).result()
 
     def __relate_feedback(self, from_id, to_id, from_type, to_type):
         info = {'from_id': from_id, 'to_id': to_id,
                 'from_type': from_type, 'to_type': to_type}
         statement = self.__add(Feedback_Relationship(**info))
         info['id'] = statement.id
+
+        if self.__feedback_graph:
+            self.__after_commit(lambda: self.__feedback_graph.add(dict(info)))
+
         return info
 
+    def relate_feedback_async(self, from_id, to_id, from_type, to_type):
+        return self.__submit(self.__q, self.__relate_feedback, from_id, to_id,
+                             from_type, to_type)
+
     def relate_feedback(self, from_id, to_id, from_type, to_type):
-        results = queue.Queue()
-        self.__q.put((self.__relate_feedback, results, from_id, to_id,
-                      from_type, to_type))
-        return results.get()
+        return self.relate_feedback_async(from_id, to_id, from_type, to_type).result()
 
     def __list_related_feedback(self, feedback_id):
-        query = self.__session.query(Feedback_Relationship)
-        found = query.filter(sqlalchemy.or_(Feedback_Relationship.from_id
-                                               ==feedback_id,
-                                               Feedback_Relationship.to_id
-                                               ==feedback_id)).all()
-        feedback_query = self.__session.query(Feedback)
+        if self.__feedback_graph:
+            found = self.__feedback_graph.related(feedback_id)
+            ids = set([s['from_id'] for s in found] + [s['to_id'] for s in found])
+            query = self.__baked('feedback_in', lambda s: s.query(Feedback).filter(
+                                     Feedback.id.in_(sqlalchemy.bindparam('ids',
+                                                                          expanding=True))))
+            feedback = {f.id: f.get_info() for f in query.params(ids=list(ids))}
+            return [{'from_id': s['from_id'], 'to_id': s['to_id'],
+                     'from_type': s['from_type'], 'to_type': s['to_type'],
+                     'from': feedback[s['from_id']],
+                     'to': feedback[s['to_id']]}
+                    for s in found]
+
+        def related(session):
+            source = sqlalchemy.orm.aliased(Feedback)
+            target = sqlalchemy.orm.aliased(Feedback)
+            related = sqlalchemy.bindparam('feedback_id')
+            return session.query(Feedback_Relationship, source, target
+                   ).join(source, Feedback_Relationship.from_id == source.id
+                   ).join(target, Feedback_Relationship.to_id == target.id
+                   ).filter(sqlalchemy.or_(Feedback_Relationship.from_id == related,
+                                           Feedback_Relationship.to_id == related))
+
+        found = self.__baked('list_related_feedback', related).params(
+                    feedback_id=feedback_id)
         return [{'from_id': s.from_id, 'to_id': s.to_id,
                  'from_type': s.from_type, 'to_type': s.to_type,
-                 'from': feedback_query.get(s.from_id).get_info(),
-                 'to': feedback_query.get(s.to_id).get_info()}
-                for s in found]
+                 'from': f.get_info(),
+                 'to': t.get_info()}
+                for s, f, t in found]
+
+    def list_related_feedback_async(self, feedback_id):
+        return self.__submit(self.__reads, self.__list_related_feedback, feedback_id)
 
     def list_related_feedback(self, feedback_id):
-        results = queue.Queue()
-        self.__q.put((self.__list_related_feedback, results, feedback_id))
-        return results.get()
+        return self.list_related_feedback_async(feedback_id).result()
+
+    def __feedback_closure(self, feedback_id, relationship_type):
+        """ Without the index walk the relationships a level (one query) at a time
+        """
+        found = set([feedback_id])
+        frontier = [feedback_id]
+
+        while frontier:
+            query = self.__session.query(Feedback_Relationship.from_id,
+                                         Feedback_Relationship.to_id).filter(
+                sqlalchemy.or_(Feedback_Relationship.from_id.in_(frontier),
+                               Feedback_Relationship.to_id.in_(frontier)))
+
+            if None != relationship_type:
+                query = query.filter(sqlalchemy.or_(
+                    Feedback_Relationship.from_type == relationship_type,
+                    Feedback_Relationship.to_type == relationship_type))
+
+            reached = set([id for pair in query for id in pair])
+            frontier = [f for f in reached if f not in found]
+            found.update(frontier)
+
+        found.remove(feedback_id)
+        return sorted(found)
+
+    def feedback_closure_async(self, feedback_id, relationship_type=None):
+        if self.__feedback_graph:
+            results = concurrent.futures.Future()
+            results.set_result(self.__feedback_graph.closure(feedback_id,
+                                                             relationship_type))
+            return results
+
+        return self.__submit(self.__reads, self.__feedback_closure, feedback_id,
+                             relationship_type)
+
+    def feedback_closure(self, feedback_id, relationship_type=None):
+        """ ids of all feedback transitively related to feedback_id
+            relationship_type - only follow relationships with this from or to type
+                                (for example 'duplicate'), None follows all of them
+        """
+        return self.feedback_closure_async(feedback_id, relationship_type).result()
+
+    def __add_missing_tallies(self, engine):
+        """ Tally the votes of feedback from before tallies were kept
+        """
+        tallied = self.__session.query(Feedback_Tally.feedback_id)
+        missing = self.__session.query(Feedback.id, Feedback.type,
+                                       sqlalchemy.func.coalesce(
+                                           sqlalchemy.func.sum(Feedback_Votes.votes), 0)
+                                       ).outerjoin(Feedback_Votes,
+                                                   Feedback_Votes.feedback_id == Feedback.id
+                                       ).filter(~Feedback.id.in_(tallied)
+                                       ).group_by(Feedback.id, Feedback.type)
+        self.__session.execute(Feedback_Tally.__table__.insert().from_select(
+            ['feedback_id', 'type', 'votes'], missing))
+        self.__session.commit()
+
+    def __tally(self, changes):
+        """ Add the change in votes to each feedback's tally
+            changes - dictionary of feedback_id to the change in its votes
+        """
+        for feedback_id, change in changes.items():
+            if change:
+                self.__session.query(Feedback_Tally).filter_by(feedback_id=feedback_id
+                    ).update({Feedback_Tally.votes: Feedback_Tally.votes + change},
+                             synchronize_session=False)
 
     def __feedback_vote(self, user_id, feedback_id, votes=None):
-        query = self.__session.query(Feedback_Votes)
-        found = query.filter_by(feedback_id=feedback_id,
-                                user_id=user_id).one_or_none()
+        self.__forget(('votes', feedback_id), ('top_feedback',))
+        query = self.__baked('feedback_vote', lambda s: s.query(Feedback_Votes).filter(
+                    Feedback_Votes.feedback_id == sqlalchemy.bindparam('feedback_id'),
+                    Feedback_Votes.user_id == sqlalchemy.bindparam('user_id')))
+        found = query.params(feedback_id=feedback_id, user_id=user_id).one_or_none()
 
         if not found:
+            self.__tally({feedback_id: votes})
             found = self.__add(Feedback_Votes(user_id=user_id,
                                               feedback_id=feedback_id,
                                               votes=votes if votes else 0))
 
         elif votes:
+            self.__tally({feedback_id: votes - found.votes})
             found.votes = votes
+            self.__commit()
 
         return found.get_info()
 
+    def feedback_vote_async(self, user_id, feedback_id, votes=None):
+        return self.__submit(self.__q, self.__feedback_vote, user_id, feedback_id, votes)
+
     def feedback_vote(self, user_id, feedback_id, votes=None):
-        results = queue.Queue()
-        self.__q.put((self.__feedback_vote, results, user_id, feedback_id, votes))
-        return results.get()
+        return self.feedback_vote_async(user_id, feedback_id, votes).result()
+
+    def __feedback_votes(self, rows):
+        votes = Connect.__mappings(rows, ('user_id', 'feedback_id', 'votes'),
+                                   {'votes': None})
+        feedback_ids = set([v['feedback_id'] for v in votes])
+        self.__forget(('top_feedback',), *[('votes', f) for f in feedback_ids])
+        query = self.__session.query(Feedback_Votes.id, Feedback_Votes.user_id,
+                                     Feedback_Votes.feedback_id, Feedback_Votes.votes)
+        found = query.filter(Feedback_Votes.feedback_id.in_(feedback_ids)).all()
+        existing = {(v.user_id, v.feedback_id): v.id for v in found}
+        previous = {(v.user_id, v.feedback_id): v.votes for v in found}
+        inserts = {}
+        updates = {}
+        changes = {}
+
+        for vote in votes:  # like feedback_vote, the last vote by a user on feedback wins
+            key = (vote['user_id'], vote['feedback_id'])
+
+            if key in existing:
+                if vote['votes']:
+                    updates[key] = {'id': existing[key], 'votes': vote['votes']}
+
+            elif key in inserts:
+                inserts[key]['votes'] = vote['votes'] or inserts[key]['votes']
+
+            else:
+                inserts[key] = {'user_id': key[0], 'feedback_id': key[1],
+                                'votes': vote['votes'] or 0}
+
+        for key, vote in updates.items():
+            changes[key[1]] = changes.get(key[1], 0) + vote['votes'] - previous[key]
+
+        for key, vote in inserts.items():
+            changes[key[1]] = changes.get(key[1], 0) + vote['votes']
+
+        self.__session.bulk_update_mappings(Feedback_Votes, list(updates.values()))
+        self.__tally(changes)
+        self.__add_all(Feedback_Votes, list(inserts.values()))
+        ids = dict(existing)
+        ids.update({k: v['id'] for k, v in inserts.items()})
+        return [ids[(v['user_id'], v['feedback_id'])] for v in votes]
+
+    def feedback_votes_async(self, rows):
+        return self.__submit(self.__q, self.__feedback_votes, rows)
+
+    def feedback_votes(self, rows):
+        """ Set many votes in one transaction
+            rows - dicts or tuples in the order of feedback_vote arguments
+            returns the vote ids in the order of rows
+        """
+        return self.feedback_votes_async(rows).result()
 
-    def __feedback_all_votes(self, feedback_id):
+    def __feedback_all_votes(self, feedback_id, limit, after):
         query = self.__session.query(Feedback_Votes)
-        found = query.filter_by(feedback_id=feedback_id).all()
-        return [v.get_info() for v in found]
+        found = query.filter_by(feedback_id=feedback_id)
+        return self.__page(found, (Feedback_Votes.id,), limit, after,
+                           lambda v: v.get_info())
+
+    def feedback_all_votes_async(self, feedback_id, limit=None, after=None):
+        Connect.__check_limit(limit)
+
+        return self.__cached(('votes', feedback_id),
+                             ('feedback_all_votes', feedback_id, limit, after),
+                             lambda: self.__submit(self.__reads, self.__feedback_all_votes,
+                                                   feedback_id, limit, after))
+
+    def feedback_all_votes(self, feedback_id, limit=None, after=None):
+        """ The votes on feedback, a page of limit of them (by id) if limit is given
+        """
+        return self.feedback_all_votes_async(feedback_id, limit, after).result()
+
+    def __feedback_tally(self, feedback_id):
+        found = self.__session.query(Feedback_Tally).get(feedback_id)
+        return found.get_info() if found else {'feedback_id': feedback_id,
+                                               'type': None, 'votes': 0}
+
+    def feedback_tally_async(self, feedback_id):
+        return self.__cached(('votes', feedback_id), ('feedback_tally', feedback_id),
+                             lambda: self.__submit(self.__reads, self.__feedback_tally,
+                                                   feedback_id))
+
+    def feedback_tally(self, feedback_id):
+        """ The total votes for feedback, kept up to date as votes are cast
+        """
+        return self.feedback_tally_async(feedback_id).result()
+
+    def __top_feedback(self, type, k, offset):
+        query = self.__session.query(Feedback, Feedback_Tally.votes).join(
+            Feedback_Tally, Feedback_Tally.feedback_id == Feedback.id)
+
+        if None != type:
+            query = query.filter(Feedback_Tally.type == type)
 
-    def feedback_all_votes(self, feedback_id):
-        results = queue.Queue()
-        self.__q.put((self.__feedback_all_votes, results, feedback_id))
-        return results.get()
+        found = query.order_by(Feedback_Tally.votes.desc(), Feedback_Tally.feedback_id
+                               ).limit(k).offset(offset)
+        return [dict(f.get_info(), votes=votes) for f, votes in found]
+
+    def top_feedback_async(self, type, k=10, offset=0):
+        return self.__cached(('top_feedback',), ('top_feedback', type, k, offset),
+                             lambda: self.__submit(self.__reads, self.__top_feedback,
+                                                   type, k, offset))
+
+    def top_feedback(self, type, k=10, offset=0):
+        """ The k most voted feedback of type (any type if None), skipping the first offset
+            returns feedback info dicts with their total votes, most votes first
+        """
+        return self.top_feedback_async(type, k, offset).result()
+
+    def __add_missing_balances(self, engine):
+        """ Total the points of users from before balances were kept
+        """
+        balanced = self.__session.query(Point_Balance.user_id)
+        missing = self.__session.query(Points.user_id, sqlalchemy.func.sum(Points.awarded)
+                                       ).filter(~Points.user_id.in_(balanced)
+                                       ).group_by(Points.user_id)
+        self.__session.execute(Point_Balance.__table__.insert().from_select(
+            ['user_id', 'balance'], missing))
+        self.__session.commit()
+
+    def __add_to_balances(self, changes):
+        """ Add points to each user's running balance
+            changes - dictionary of user_id to the points awarded
+        """
+        for user_id, change in changes.items():
+            updated = self.__session.query(Point_Balance).filter_by(user_id=user_id
+                ).update({Point_Balance.balance: Point_Balance.balance + change},
+                         synchronize_session=False)
 
-    def __user_points(self, user_id, awarded=None, reason=""):
+            if not updated:
+                self.__session.add(Point_Balance(user_id=user_id, balance=change))
+
+    def __user_points(self, user_id, awarded=None, reason="", limit=None, after=None):
         if awarded:
+            self.__forget(('points', user_id))
+            self.__add_to_balances({user_id: awarded})
             created = self.__add(Points(user_id=user_id,
                                         awarded=awarded,
                                         when=datetime.datetime.now(),
                                         reason=reason))
             return created.get_info()
 
-        found = self.__session.query(Points).filter_by(user_id=user_id).all()
-        return [x.get_info() for x in found]
+        found = self.__session.query(Points).filter_by(user_id=user_id)
+        return self.__page(found, (Points.when, Points.id), limit, after,
+                           lambda x: x.get_info())
+
+    def user_points_async(self, user_id, awarded=None, reason="", limit=None, after=None):
+        if awarded:
+            return self.__submit(self.__q, self.__user_points, user_id, awarded, reason)
+
+        Connect.__check_limit(limit)
+
+        return self.__cached(('points', user_id), ('user_points', user_id, limit, after),
+                             lambda: self.__submit(self.__reads, self.__user_points,
+                                                   user_id, None, reason, limit, after))
+
+    def user_points(self, user_id, awarded=None, reason="", limit=None, after=None):
+        """ Award the user points, or if awarded is None list their points
+            (a page of limit of them, oldest first, if limit is given)
+        """
+        return self.user_points_async(user_id, awarded, reason, limit, after).result()
+
+    def iter_points(self, user_id, chunk=1000):
+        """ Generator of all the user's points (oldest first) read chunk at a time
+            (pages skip the result cache)
+        """
+        Connect.__check_limit(chunk)
+        return self.__iterate(lambda limit, after: self.__submit(
+                                  self.__reads, self.__user_points, user_id, None, "",
+                                  limit, after).result(), chunk)
+
+    def __award_points(self, rows):
+        fields = ('user_id', 'awarded', 'reason', 'when')
+        points = Connect.__mappings(rows, fields, {'reason': '',
+                                                   'when': datetime.datetime.now()})
+        changes = {}
+
+        for point in points:
+            changes[point['user_id']] = changes.get(point['user_id'], 0) + point['awarded']
+
+        self.__forget(*[('points', u) for u in changes])
+        self.__add_to_balances(changes)
+        return self.__add_all(Points, points)
+
+    def award_points_async(self, rows):
+        return self.__submit(self.__q, self.__award_points, rows)
+
+    def award_points(self, rows):
+        """ Award many points in one transaction
+            rows - dicts or tuples of (user_id, awarded, reason, when)
+                   reason defaults to "" and when to now
+            returns the new points ids in the order of rows
+        """
+        return self.award_points_async(rows).result()
+
+    def __point_balance(self, user_id, as_of):
+        if None == as_of:
+            found = self.__session.query(Point_Balance).get(user_id)
+            return found.balance if found else 0
+
+        query = self.__session.query(sqlalchemy.func.coalesce(
+            sqlalchemy.func.sum(Points.awarded), 0))
+        return query.filter(Points.user_id == user_id, Points.when <= as_of).scalar()
+
+    def point_balance_async(self, user_id, as_of=None):
+        return self.__cached(('points', user_id), ('point_balance', user_id, as_of),
+                             lambda: self.__submit(self.__reads, self.__point_balance,
+                                                   user_id, as_of))
+
+    def point_balance(self, user_id, as_of=None):
+        """ The user's total points, now (kept as a running balance) or as of a datetime
+        """
+        return self.point_balance_async(user_id, as_of).result()
+
+    @staticmethod
+    def __period_start(when, period, dialect):
+        """ SQL of the first date of the day, week (starting Monday) or month of when
+        """
+        func = sqlalchemy.func
+
+        if 'sqlite' == dialect:
+            modifiers = {'day': [], 'week': ["'weekday 0'", "'-6 days'"],
+                         'month': ["'start of month'"]}[period]
+            return func.date(when, *[sqlalchemy.literal_column(m) for m in modifiers])
+
+        if 'mysql' == dialect:
+            back = {'day': 0, 'week': func.weekday(when),
+                    'month': func.dayofmonth(when) - 1}[period]
+            return func.subdate(func.date(when), back)
+
+        return sqlalchemy.cast(func.date_trunc(period, when), sqlalchemy.Date)
+
+    def __points_per_period(self, user_id, period, start, end):
+        period_start = Connect.__period_start(Points.when, period,
+                                              self.__session.get_bind().dialect.name)
+        query = self.__session.query(period_start.label('period'),
+                                     sqlalchemy.func.sum(Points.awarded)).filter(
+            Points.user_id == user_id)
+
+        if None != start:
+            query = query.filter(Points.when >= start)
+
+        if None != end:
+            query = query.filter(Points.when < end)
+
+        found = query.group_by(period_start).order_by(period_start)
+        return [{'period': datetime.date.fromisoformat(p) if isinstance(p, str) else p,
+                 'awarded': awarded} for p, awarded in found]
+
+    def points_per_period_async(self, user_id, period='day', start=None, end=None):
+        if period not in ('day', 'week', 'month'):
+            raise ValueError('period must be day, week or month: ' + str(period))
+
+        return self.__cached(('points', user_id),
+                             ('points_per_period', user_id, period, start, end),
+                             lambda: self.__submit(self.__reads, self.__points_per_period,
+                                                   user_id, period, start, end))
+
+    def points_per_period(self, user_id, period='day', start=None, end=None):
+        """ Points awarded to the user per day, week (starting Monday) or month
+            start, end - only count points awarded from start up to (not including) end
+            returns {'period': first date of the period, 'awarded': points} oldest first,
+                    points without a when are totalled first with period None
+        """
+        return self.points_per_period_async(user_id, period, start, end).result()
+
+    def __point_history(self, user_id, limit, after):
+        query = self.__session.query(Points).filter(Points.user_id == user_id)
+        return self.__page(query, (Points.when, Points.id), limit, after,
+                           lambda x: x.get_info(), descending=True)
+
+    def point_history_async(self, user_id, limit=50, after=None):
+        Connect.__check_limit(limit)
 
-    def user_points(self, user_id, awarded=None, reason=""):
-        results = queue.Queue()
-        self.__q.put((self.__user_points, results, user_id, awarded, reason))
-        return results.get()
+        return self.__cached(('points', user_id), ('point_history', user_id, limit, after),
+                             lambda: self.__submit(self.__reads, self.__point_history,
+                                                   user_id, limit, after))
+
+    def point_history(self, user_id, limit=50, after=None):
+        """ A page of the user's points, newest first
+            after - the 'next' of the previous page, None for the first page
+            returns {'results': list of points info, 'next': cursor or None at the end}
+        """
+        return self.point_history_async(user_id, limit, after).result()
 
     def __flush(self):
-        self.__session.commit()
+        self.__commit()
         return None
 
+    def flush_async(self):
+        return self.__submit(self.__q, self.__flush)
+
     def flush(self):
-        results = queue.Queue()
-        self.__q.put((self.__flush, results))
-        return results.get()
+        return self.flush_async().result()
+
+    def __execute(self, command):
+        started = time.monotonic()
+
+        try:
+            result = command[0](*command[3:])
+            self.__committed(True)
+            self.__metrics.observe(Connect.__command_name(command), started - command[2],
+                                   time.monotonic() - started)
+            command[1].set_result(result)
+
+        except:
+            logging.error(traceback.format_exc())
+            self.__session.rollback()
+            self.__committed(False)
+            self.__metrics.observe(Connect.__command_name(command), started - command[2],
+                                   time.monotonic() - started, True)
+            command[1].set_result((traceback.format_exc(),))
+
+    def __next_batch(self, commands, command):
+        """ Gather the writes queued behind command, waiting up to batch_linger for more
+            returns the batch and whether the stop (None) command was seen
+        """
+        batch = [command]
+        deadline = time.monotonic() + self.__batch_linger
 
-    def run(self):
-        engine = self.__init()
+        while len(batch) < self.__batch_size:
+            try:
+                command = commands.get(timeout=max(0.0, deadline - time.monotonic()))
+
+            except queue.Empty:
+                break
+
+            if None == command:
+                return (batch, True)
+
+            batch.append(command)
+
+        return (batch, False)
+
+    def __execute_batch(self, batch):
+        """ Apply writes in one transaction with one commit, if anything fails
+            roll it all back and apply them one at a time so each gets its own error
+        """
+        self.__batching = True
+        timings = []
+
+        try:
+            results = []
+
+            for command in batch:
+                started = time.monotonic()
+                results.append(command[0](*command[3:]))
+                timings.append((started - command[2], time.monotonic() - started))
+
+            started = time.monotonic()
+            self.__session.commit()
+            self.__metrics.observe_commit(time.monotonic() - started)
+            self.__committed(True)
+
+        except:
+            logging.warning('batch of %d writes failed, applying one at a time'%(len(batch)))
+            self.__session.rollback()
+            self.__committed(False)
+            results = None
+
+        finally:
+            self.__batching = False
+
+        if None == results:
+            for command in batch:
+                self.__execute(command)
+
+        else:
+            for command, result, (waited, executed) in zip(batch, results, timings):
+                self.__metrics.observe(Connect.__command_name(command), waited, executed)
+                command[1].set_result(result)
+
+    def __session_policy(self):
+        return bool(self.__session_commands or self.__session_megabytes)
+
+    def __open_session(self, read_only):
+        if read_only and self.__read_factory:  # this thread's session reads on its own
+            self.__session.registry.set(self.__read_factory())
+
+        if self.__session_megabytes:
+            self.__local.resident = Connect.__resident_megabytes() or 0
+
+    def __end_commands(self, read_only, commands):
+        """ Apply the session policy once commands have run in this thread's session
+        """
+        local = self.__local
+        local.commands = getattr(local, 'commands', 0) + commands
+        local.recycled = getattr(local, 'recycled', 0)
+        session = self.__session()
+
+        # a session with changes still to commit is kept as it is
+        if self.__session_policy() and not (session.new or session.dirty or session.deleted):
+            session.expunge_all()
+
+            if ((self.__session_commands and local.commands >= self.__session_commands)
+                or (self.__session_megabytes and (Connect.__resident_megabytes() or 0)
+                    - local.resident > self.__session_megabytes)):
+                self.__session.remove()
+                self.__open_session(read_only)
+                local.commands = 0
+                local.recycled += 1
+
+        self.__sessions[threading.current_thread().name] = {
+            'identity_map': len(self.__session().identity_map),
+            'commands': local.commands, 'recycled': local.recycled}
+
+    def __serve(self, commands, read_only):
+        self.__open_session(read_only)
 
         while self.__running:
-            command = self.__q.get()
+            command = commands.get()
 
             if None == command:
                 break
 
-            try:
-                command[1].put(command[0](*command[2:]))
+            if read_only or self.__batch_size < 2:
+                self.__execute(command)
+                batch, stop = ([command], False)
 
-            except:
-                logging.error(traceback.format_exc())
-                command[1].put((traceback.format_exc(),))
+            else:
+                batch, stop = self.__next_batch(commands, command)
+                self.__execute_batch(batch)
+
+            if read_only:  # end the transaction so the next read sees new commits
+                self.__session.rollback()
+
+            self.__end_commands(read_only, len(batch))
+
+            if stop:
+                break
+
+        self.__session.remove()
+
+    def run(self):
+        try:
+            engine = self.__init()
+
+        except Exception as error:
+            # the constructor raises it, nothing can have been queued yet
+            self.__failed = error
+            return
+
+        finally:
+            self.__started.set()
+
+        for number in range(0, self.__workers):
+            reader = threading.Thread(target=self.__serve, args=(self.__reads, True),
+                                      name='%s-reader-%d'%(self.name, number))
+            reader.start()
+            self.__readers.append(reader)
+
+        self.__serve(self.__q, False)
+
+        for reader in self.__readers:
+            self.__reads.put(None)
 
-        self.__session.close()
+        for reader in self.__readers:
+            reader.join()
 
+        engine.dispose()
 
+        if self.__read_engine:
+            self.__read_engine.dispose()
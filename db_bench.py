@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+""" Benchmark the storage layer on data filled by db_test's fill helpers, scaled up
+
+    Every public db.Connect method is timed call by call. Results are appended to
+    the output file as one JSON object per run, so runs can be compared over time.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import sqlalchemy
+import subprocess
+import time
+import db
+import db_test
+
+# at scale 1.0
+USERS = 10000
+STATEMENTS = 1000000
+POINTS = 5000000
+CHUNK = 10000  # rows per bulk write
+
+
+class Timed_Connect:
+    """ Passes calls through to a db.Connect, timing each public method call
+        and giving the fixture users of db_test their own emails for each replica
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.replica = None
+        self.latencies = {}  # method name to list of seconds
+        self.rows = {}  # method name to rows written by bulk calls
+        self.errors = {}  # method name to calls that returned an error
+
+    def __email(self, email):
+        if None == self.replica:
+            return email
+
+        name, domain = email.split('@')
+        return '%s+%d@%s'%(name, self.replica, domain)
+
+    def add_user(self, referrer_id, email, password):
+        return self.call('add_user', referrer_id, self.__email(email), password)
+
+    def login_user(self, email, password):
+        return self.call('login_user', self.__email(email), password)
+
+    def call(self, name, *args, **kwargs):
+        started = time.perf_counter()
+        result = getattr(self.database, name)(*args, **kwargs)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+        if isinstance(result, tuple):
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+        if name in ('add_accounts', 'add_statements', 'award_points', 'feedback_votes'):
+            self.rows[name] = self.rows.get(name, 0) + len(args[0])
+
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name.endswith('_async') or name in ('metrics',
+                                                                        'cache_stats'):
+            return getattr(self.database, name)
+
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(timed):
+    """ Throughput and latency percentiles (in milliseconds) of every method called
+    """
+    summary = {}
+
+    for name, latencies in sorted(timed.latencies.items()):
+        ordered = sorted(latencies)
+        total = sum(ordered)
+        summary[name] = {'calls': len(ordered), 'seconds': total,
+                         'calls_per_second': len(ordered) / total if total else None,
+                         'p50_ms': percentile(ordered, 0.50) * 1000.0,
+                         'p99_ms': percentile(ordered, 0.99) * 1000.0,
+                         'max_ms': ordered[-1] * 1000.0,
+                         'errors': timed.errors.get(name, 0)}
+
+        if name in timed.rows:
+            summary[name]['rows_per_second'] = timed.rows[name] / total if total else None
+
+    return summary
+
+
+def fill(timed, scale):
+    """ Replicate db_test's fixture until there are USERS * scale users, then bulk add
+        statements and points up to STATEMENTS * scale and POINTS * scale
+        returns the ids of the users and accounts
+    """
+    replicas = max(1, int(USERS * scale) // 2)  # the fixture has 2 users
+
+    for replica in range(0, replicas):
+        timed.replica = replica
+        db_test.test_fill_db_users(timed)
+        db_test.test_fill_db_accounts(timed)
+        db_test.test_fill_db_statements(timed)
+        db_test.test_fill_db_feedback(timed)
+        db_test.test_fill_db_points(timed)
+
+    timed.flush()
+    timed.replica = None
+    user_ids = list(range(1, 2 * replicas + 1))
+    accounts = [a['id'] for u in user_ids for a in timed.database.list_accounts(u)]
+    start = datetime.date(2000, 1, 1)
+    rows = []
+
+    for n in range(0, max(0, int(STATEMENTS * scale) - 2 * replicas)):
+        month = n // len(accounts)
+        first = datetime.date(start.year + month // 12, month % 12 + 1, 1)
+        rows.append((accounts[n % len(accounts)], first.strftime('%Y/%m/%d'),
+                     (first + datetime.timedelta(days=27)).strftime('%Y/%m/%d'), None,
+                     1.00, 0.25, 100.00, 90.00, 1000.00 + month, 1010.25 + month))
+
+        if len(rows) == CHUNK:
+            timed.add_statements(rows)
+            rows = []
+
+    if rows:
+        timed.add_statements(rows)
+
+    now = datetime.datetime.now()
+    rows = []
+
+    for n in range(0, max(0, int(POINTS * scale) - 4 * replicas)):
+        rows.append((user_ids[n % len(user_ids)], 1 + n % 10, 'bench',
+                     now - datetime.timedelta(minutes=n // len(user_ids))))
+
+        if len(rows) == CHUNK:
+            timed.award_points(rows)
+            rows = []
+
+    if rows:
+        timed.award_points(rows)
+
+    return user_ids, accounts
+
+
+def read(timed, user_ids, accounts, calls, seed):
+    """ Time calls random calls of each read method
+    """
+    chosen = random.Random(seed)
+    feedback_ids = [f['id'] for u in user_ids[:20] for f in timed.database.list_feedback(u)]
+
+    for _ in range(0, calls):
+        user_id = chosen.choice(user_ids)
+        account_id = chosen.choice(accounts)
+        feedback_id = chosen.choice(feedback_ids)
+        timed.login_user('me+%d@me.com'%(chosen.randrange(0, len(user_ids) // 2)),
+                         'secret')
+        timed.list_accounts(user_id)
+        timed.list_statements(account_id, 50)
+        timed.net_worth(user_id)
+        timed.list_feedback(user_id)
+        timed.list_related_feedback(feedback_id)
+        timed.feedback_closure(feedback_id)
+        timed.feedback_all_votes(feedback_id)
+        timed.feedback_tally(feedback_id)
+        timed.top_feedback('BUG')
+        timed.user_points(user_id, limit=50)
+        timed.point_balance(user_id)
+        timed.points_per_period(user_id, 'month')
+        timed.point_history(user_id)
+
+    for _ in range(0, max(1, calls // 10)):
+        timed.statement_columns([chosen.choice(user_ids)], None)
+        started = time.perf_counter()
+        sum(1 for _ in timed.database.iter_statements(chosen.choice(accounts)))
+        timed.latencies.setdefault('iter_statements', []).append(time.perf_counter()
+                                                                  - started)
+
+
+def write(timed, user_ids, accounts, calls, seed):
+    """ Time calls random single row writes of each write method
+    """
+    chosen = random.Random(seed)
+
+    for n in range(0, calls):
+        user = timed.add_user(None, 'bench+%d+%d@me.com'%(seed, n), 'secret')
+        timed.set_user_birthday(user['id'], '1990/01/01')
+        account = timed.add_account(chosen.choice(user_ids), 'bench', 'http://bank.com/',
+                                    'usual login', 'SAVE')
+        timed.add_statement(account['id'], '2020/06/01', '2020/06/30', None,
+                            1.00, 0.25, 100.00, 90.00, 1000.00, 1010.25)
+        feedback = timed.add_feedback(chosen.choice(user_ids), 'BUG', 'bench', 'bench')
+        timed.relate_feedback(feedback['id'], feedback['id'] - 1, 'related', 'related')
+        timed.feedback_vote(chosen.choice(user_ids), feedback['id'], 1 + n % 5)
+        timed.user_points(chosen.choice(user_ids), 1, 'bench')
+
+
+def mysql_empty(url):
+    """ Drop the tables of url so the run starts empty, False if it can not be reached
+    """
+    try:
+        engine = sqlalchemy.create_engine(url)
+        db.Alchemy_Base.metadata.drop_all(engine)
+        engine.dispose()
+        return True
+
+    except Exception as error:
+        logging.warning('skipping %s: %s'%(url, error))
+        return False
+
+
+def run(url, scale, calls, seed, workers, batch_size):
+    """ returns the summary of filling url at scale then reading and writing it
+    """
+    with db.Connect(url, workers, batch_size) as database:
+        timed = Timed_Connect(database)
+        started = time.perf_counter()
+        user_ids, accounts = fill(timed, scale)
+        filled = time.perf_counter() - started
+        read(timed, user_ids, accounts, calls, seed)
+        write(timed, user_ids, accounts, calls, seed)
+        return {'url': url, 'fill_seconds': filled, 'users': len(user_ids),
+                'accounts': len(accounts), 'methods': summarize(timed)}
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode().strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the storage layer')
+    parser.add_argument('-s', '--scale', type=float, default=0.01,
+                        help='Fraction of %d users, %d statements and %d points to fill'%(
+                             USERS, STATEMENTS, POINTS))
+    parser.add_argument('-c', '--calls', type=int, default=200,
+                        help='Number of timed calls of each read and write method')
+    parser.add_argument('-u', '--url', action='append', default=None,
+                        help='SQLAlchemy url of an empty database to benchmark, can be '
+                             'repeated (default a new SQLite file in /tmp)')
+    parser.add_argument('-m', '--mysql',
+                        default='mysql+mysqlconnector://root@localhost/game_bench',
+                        help='MySQL url to benchmark too if it can be reached (its tables '
+                             'are dropped first), "" for none')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of threads serving database reads')
+    parser.add_argument('-b', '--batch-size', type=int, default=1,
+                        help='Most database writes to commit together')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the random calls')
+    parser.add_argument('-o', '--output', default='db_bench.jsonl',
+                        help='File to append this run\'s results to as a line of JSON')
+    return parser.parse_args()
+
+
+def main(args):
+    logging.basicConfig()
+    urls = args.url or [db_test.sqlite_new_file('/tmp/db.bench.sqlite3')]
+
+    if args.mysql and mysql_empty(args.mysql):
+        urls.append(args.mysql)
+
+    results = {'when': datetime.datetime.now().isoformat(), 'revision': revision(),
+               'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__,
+               'scale': args.scale, 'calls': args.calls, 'workers': args.workers,
+               'batch_size': args.batch_size,
+               'runs': [run(url, args.scale, args.calls, args.seed, args.workers,
+                            args.batch_size) for url in urls]}
+
+    with open(args.output, 'a') as output:
+        output.write(json.dumps(results) + '\n')
+
+    for result in results['runs']:
+        print(result['url'])
+
+        for name, method in result['methods'].items():
+            print('    %-20s %8d calls %10.1f/s  p50 %8.3fms  p99 %8.3fms'%(
+                  name, method['calls'], method['calls_per_second'] or 0.0,
+                  method['p50_ms'], method['p99_ms']))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import db
+import functools
 import logging
 import os
+import sqlite3
 import datetime
 import time
 
@@ -28,12 +30,50 @@ def test_db_contents_users(database):
     if you['id'] == None or not you['valid'] or you['email'] != 'u@me.com':
         raise SyntaxError('logging me in failed: ' + str(you))
 
+    shouted = database.login_user(' ME@Me.com', 'secret')
+
+    if shouted['id'] != myself['id'] or not shouted['valid']:
+        raise SyntaxError('logging me in by a differently written email failed: '
+                          + str(shouted))
+
+    if database.add_user(None, 'Me@me.com', 'secret')['valid']:
+        raise SyntaxError('adding me again by a differently written email passed')
+
     other = database.login_user('other@me.com', 'halls pass')
 
     if other['id'] != None or other['valid'] or other['email'] != 'other@me.com':
         raise SyntaxError('logging other in passed and should not have: ' + str(other))
 
 
+def test_salted_passwords(database):
+    test_db_contents_users(database)  # hashed before, with User.hash
+    salted = database.add_user(None, 'salted@me.com', 'secret')
+    again = database.add_user(None, 'salted+again@me.com', 'secret')
+    hashes = [database.set_user_birthday(u['id'], '1990/01/01')['password_hash']
+              for u in (salted, again)]
+
+    if not hashes[0].startswith('pbkdf2_sha256$') or hashes[0] == hashes[1]:
+        raise SyntaxError('new passwords were not salted: ' + str(hashes))
+
+    if (not database.login_user('salted@me.com', 'secret')['valid']
+        or database.login_user('salted@me.com', 'wrong')['valid']):
+        raise SyntaxError('salted logins were not what we expected')
+
+
+def test_db_contents_async(database):
+    pending = [database.login_user_async('me@me.com', 'secret'),
+               database.login_user_async('u@me.com', 'secret')]
+    myself, you = [x.result() for x in pending]
+
+    if not myself['valid'] or you['valid']:
+        raise SyntaxError('async logins were not what we expected: %s %s'%(myself, you))
+
+    accounts = database.list_accounts_async(myself['id']).result()
+
+    if accounts != database.list_accounts(myself['id']):
+        raise SyntaxError('async accounts do not match: ' + str(accounts))
+
+
 def test_fill_db_accounts(database):
     myself = database.login_user('me@me.com', 'secret')
     you = database.login_user('u@me.com', 'toomanysecrets')
@@ -219,6 +259,38 @@ def test_db_contents_statements(database):
                           + str(june_statement[0]))
 
 
+def test_db_contents_net_worth(database):
+    myself = database.login_user('me@me.com', 'secret')
+    you = database.login_user('u@me.com', 'toomanysecrets')
+    my_accounts = database.list_accounts(myself['id'])
+    my_house = [x for x in my_accounts if x['type'] == 'HOUSE'][0]
+    my_mortgage = [x for x in my_accounts if x['type'] == 'MORT'][0]
+    my_worth = database.net_worth(myself['id'])
+
+    if my_worth['net_worth'] != 664.69 or my_worth['debts'] != 0.0:
+        raise SyntaxError('Expected net worth 664.69 but got ' + str(my_worth))
+
+    may_worth = database.net_worth(myself['id'], datetime.date(2020, 6, 1))
+
+    if may_worth['net_worth'] != 1000.00:
+        raise SyntaxError('Expected net worth 1000.00 but got ' + str(may_worth))
+
+    database.add_statement(my_house['id'], '2020/06/01', '2020/06/30', None,
+                           0.00, 0.00, 0.00, 0.00, 300000.00, 310000.00)
+    database.add_statement(my_mortgage['id'], '2020/06/01', '2020/06/30', '2020/07/01',
+                           0.00, 800.00, 1500.00, 0.00, 250700.00, 250000.00)
+    my_worth = database.net_worth(myself['id'])
+    house = [x for x in my_worth['accounts'] if x['id'] == my_house['id']][0]
+
+    if (my_worth['net_worth'] != 310000.00 + 664.69 - 250000.00
+        or my_worth['debts'] != 250000.00 or house['equity'] != 60000.00):
+        raise SyntaxError('Expected net worth 60664.69 but got ' + str(my_worth))
+
+    if database.net_worth(you['id'])['net_worth'] != 0.0:
+        raise SyntaxError('Expected no net worth but got '
+                          + str(database.net_worth(you['id'])))
+
+
 def test_fill_db_feedback(database):
     myself = database.login_user('me@me.com', 'secret')
     you = database.login_user('u@me.com', 'toomanysecrets')
@@ -350,6 +422,17 @@ def test_db_contents_feedback(database):
         raise SyntaxError('We expected 1 related but got' +
                           ' %d'%(len(your_request_related_your_bug)))
 
+    my_bug_duplicates = database.feedback_closure(my_bug[0]['id'], 'duplicate')
+    my_bug_closure = database.feedback_closure(my_bug[0]['id'])
+
+    if my_bug_duplicates != [your_bug[0]['id']]:
+        raise SyntaxError('Expected duplicate %d but got %s'%(your_bug[0]['id'],
+                                                             my_bug_duplicates))
+
+    if my_bug_closure != sorted([your_bug[0]['id'], your_request[0]['id'],
+                                 my_request[0]['id']]):
+        raise SyntaxError('Expected all feedback related but got %s'%(my_bug_closure))
+
     my_bug_votes = database.feedback_all_votes(my_bug[0]['id'])
     my_request_votes = database.feedback_all_votes(my_request[0]['id'])
     your_bug_votes = database.feedback_all_votes(your_bug[0]['id'])
@@ -403,6 +486,21 @@ def test_db_contents_feedback(database):
         raise SyntaxError('Expected 330 but got ' +
                           '%d'%(sum([x['votes'] for x in your_request_votes])))
 
+    tallies = [database.feedback_tally(x[0]['id'])['votes']
+               for x in (my_bug, my_request, your_bug, your_request)]
+
+    if tallies != [110, 40, 220, 330]:
+        raise SyntaxError('Expected tallies [110, 40, 220, 330] but got %s'%(tallies))
+
+    top_bugs = database.top_feedback('BUG', 1)
+    top_requests = database.top_feedback('REQUEST')
+
+    if [x['id'] for x in top_bugs] != [your_bug[0]['id']] or top_bugs[0]['votes'] != 220:
+        raise SyntaxError('Expected your bug on top but got %s'%(top_bugs))
+
+    if [x['votes'] for x in top_requests] != [330, 40]:
+        raise SyntaxError('Expected requests with 330, 40 votes but got %s'%(top_requests))
+
 
 def test_fill_db_points(database):
     myself = database.login_user('me@me.com', 'secret')
@@ -462,6 +560,441 @@ def test_db_contents_points(database):
     if your_emergency[0]['when'] >= your_yep[0]['when']:
         raise SyntaxError('Wrong order %s >= %s'%(my_daily_visit, my_debt_free))
 
+    if database.point_balance(myself['id']) != 11:
+        raise SyntaxError('Expected balance 11 but got %d'%(
+                          database.point_balance(myself['id'])))
+
+    if database.point_balance(you['id'], your_emergency[0]['when']) != 5:
+        raise SyntaxError('Expected balance 5 but got %d'%(
+                          database.point_balance(you['id'], your_emergency[0]['when'])))
+
+    my_months = database.points_per_period(myself['id'], 'month')
+
+    if sum([x['awarded'] for x in my_months]) != 11 or my_months[0]['period'].day != 1:
+        raise SyntaxError('Expected 11 points by month but got %s'%(my_months))
+
+    first_page = database.point_history(myself['id'], 1)
+    second_page = database.point_history(myself['id'], 1, first_page['next'])
+
+    if ([x['id'] for x in first_page['results'] + second_page['results']]
+        != [my_debt_free[0]['id'], my_daily_visit[0]['id']] or second_page['next']):
+        raise SyntaxError('Expected newest points first but got %s %s'%(
+                          first_page, second_page))
+
+
+def test_points_per_period(database):
+    periodic = database.add_user(None, 'periodic@me.com', 'secret')
+    database.award_points([(periodic['id'], 1, 'sunday', datetime.datetime(2020, 6, 7, 12)),
+                           (periodic['id'], 2, 'monday', datetime.datetime(2020, 6, 8)),
+                           (periodic['id'], 4, 'tuesday',
+                            datetime.datetime(2020, 6, 30, 23, 59)),
+                           (periodic['id'], 8, 'wednesday', datetime.datetime(2020, 7, 1)),
+                           {'user_id': periodic['id'], 'awarded': 16, 'when': None}])
+    found = {period: [(x['period'] and str(x['period']), x['awarded'])
+                      for x in database.points_per_period(periodic['id'], period)]
+             for period in ('day', 'week', 'month')}
+    expected = {'day': [(None, 16), ('2020-06-07', 1), ('2020-06-08', 2),
+                        ('2020-06-30', 4), ('2020-07-01', 8)],
+                'week': [(None, 16), ('2020-06-01', 1), ('2020-06-08', 2),
+                         ('2020-06-29', 12)],
+                'month': [(None, 16), ('2020-06-01', 7), ('2020-07-01', 8)]}
+
+    if found != expected:
+        raise SyntaxError('points per period were not what we expected: ' + str(found))
+
+    june = database.points_per_period(periodic['id'], 'month', datetime.datetime(2020, 6, 1),
+                                      datetime.datetime(2020, 7, 1))
+
+    if june != [{'period': datetime.date(2020, 6, 1), 'awarded': 7}]:
+        raise SyntaxError('points per period from start to end were not what we '
+                          'expected: ' + str(june))
+
+
+def test_batched_writes(database, email='batch@me.com'):
+    batch = database.add_user(None, email, 'secret')
+    pending = [database.user_points_async(batch['id'], 1, 'batch %d'%(x))
+               for x in range(0, 100)]
+    bad = database.add_statement_async(None, '2020/06/01', '2020/06/30', None,
+                                       None, None, None, None, None, None)
+    awarded = [x.result() for x in pending]
+
+    if len(set([x['id'] for x in awarded])) != 100:
+        raise SyntaxError('batched points did not get their own ids: ' + str(awarded))
+
+    if not isinstance(bad.result(), tuple):
+        raise SyntaxError('bad statement in a batch should fail: ' + str(bad.result()))
+
+    if len(database.user_points(batch['id'])) != 100:
+        raise SyntaxError('Expected 100 but got %d'%(len(database.user_points(batch['id']))))
+
+    if database.point_balance(batch['id']) != 100:
+        raise SyntaxError('Expected 100 but got %d'%(database.point_balance(batch['id'])))
+
+    streamed = database.iter_points(batch['id'], 7)
+    first = next(streamed)
+    streamed.close()
+
+    if first['reason'] != 'batch 0' or len(list(database.iter_points(batch['id']))) != 100:
+        raise SyntaxError('Expected 100 points oldest first but got ' + str(first))
+
+
+def test_bulk_writes(database):
+    bulk = database.add_user(None, 'bulk@me.com', 'secret')
+    accounts = database.add_accounts([(bulk['id'], 'bulk savings', 'http://bank.com/',
+                                       'usual login', 'SAVE'),
+                                      {'user_id': bulk['id'], 'name': 'bulk cc',
+                                       'url': 'http://bank.com/', 'info': 'usual login',
+                                       'type': 'CC', 'interest_rate': 19.9}])
+
+    if len(database.list_accounts(bulk['id'])) != 2:
+        raise SyntaxError('Expected 2 bulk accounts but got '
+                          + str(database.list_accounts(bulk['id'])))
+
+    statements = database.add_statements([(accounts[0], '2020/%02d/01'%(m),
+                                           '2020/%02d/28'%(m), None,
+                                           1.00, 0.50, 100.00, 50.00,
+                                           1000.00 + m, 1049.50 + m)
+                                          for m in range(1, 13)])
+    found = database.list_statements(accounts[0])
+
+    if sorted(statements) != sorted([x['id'] for x in found]):
+        raise SyntaxError('bulk statement ids %s do not match %s'%(statements, found))
+
+    if (len(set(statements)) != 12 or [x['start'].month for x in sorted(
+            found, key=lambda x: statements.index(x['id']))] != list(range(1, 13))):
+        raise SyntaxError('bulk statement ids are not one per row in order: '
+                          + str(statements))
+
+    if sum([x['end_balance'] for x in found]) != 12 * 1049.50 + 78:
+        raise SyntaxError('bulk statements are not what we expected: ' + str(found))
+
+    pages = [database.list_statements(accounts[0], 5)]
+
+    while pages[-1]['next']:
+        pages.append(database.list_statements(accounts[0], 5, pages[-1]['next']))
+
+    paged = [x['start'] for p in pages for x in p['results']]
+
+    if len(pages) != 3 or paged != sorted([x['start'] for x in found]):
+        raise SyntaxError('statement pages are not what we expected: ' + str(pages))
+
+    for bad in (lambda: database.list_statements(accounts[0], 0),
+                lambda: database.point_history(bulk['id'], 0),
+                lambda: database.user_points(bulk['id'], limit=-1),
+                lambda: database.iter_statements(accounts[0], 0)):
+        try:
+            bad()
+
+        except ValueError:
+            continue
+
+        raise SyntaxError('a page of less than one row did not raise ValueError')
+
+    streamed = [x['start'] for x in database.iter_statements(accounts[0], 5)]
+
+    if streamed != paged:
+        raise SyntaxError('streamed statements are not what we expected: ' + str(streamed))
+
+    points = database.award_points([(bulk['id'], x, 'bulk') for x in range(1, 11)])
+
+    if sum([x['awarded'] for x in database.user_points(bulk['id'])]) != 55:
+        raise SyntaxError('bulk points are not what we expected: ' + str(points))
+
+    if database.point_balance(bulk['id']) != 55:
+        raise SyntaxError('bulk points balance is not what we expected: '
+                          + str(database.point_balance(bulk['id'])))
+
+    feedback = database.add_feedback(bulk['id'], 'BUG', 'bulk', 'bulk votes')
+    first = database.feedback_vote(bulk['id'], feedback['id'], 5)
+    votes = database.feedback_votes([(bulk['id'], feedback['id'], 7),
+                                     (bulk['id'] + 1, feedback['id'], 3),
+                                     (bulk['id'] + 1, feedback['id'])])
+
+    if votes != [first['id'], votes[1], votes[1]] or votes[1] == first['id']:
+        raise SyntaxError('bulk vote ids are not what we expected: ' + str(votes))
+
+    if sum([x['votes'] for x in database.feedback_all_votes(feedback['id'])]) != 10:
+        raise SyntaxError('bulk votes are not what we expected: '
+                          + str(database.feedback_all_votes(feedback['id'])))
+
+    if database.feedback_tally(feedback['id'])['votes'] != 10:
+        raise SyntaxError('bulk votes tally is not what we expected: '
+                          + str(database.feedback_tally(feedback['id'])))
+
+    mixed = database.add_statements([(accounts[1], '2021-01-01', '2021/01/31',
+                                       datetime.date(2021, 2, 14), 0.00, 0.00, 0.00, 0.00,
+                                       0.00, 0.00)])
+    found = [x for x in database.list_statements(accounts[1]) if x['id'] == mixed[0]]
+
+    if [found[0]['start'], found[0]['end'], found[0]['due']] != [
+        datetime.date(2021, 1, 1), datetime.date(2021, 1, 31), datetime.date(2021, 2, 14)]:
+        raise SyntaxError('ISO, slashed and date dates did not match: ' + str(found))
+
+    database.add_statements([(accounts[1], None, '2021/%02d/28'%(m), None, 0.00, 0.00,
+                              0.00, 0.00, 0.00, 0.00) for m in range(3, 6)])
+    listed = [x['id'] for x in database.list_statements(accounts[1])]
+    pages = [database.list_statements(accounts[1], 1)]
+
+    while pages[-1]['next']:
+        pages.append(database.list_statements(accounts[1], 1, pages[-1]['next']))
+
+    paged = [x['id'] for p in pages for x in p['results']]
+
+    if (sorted(paged) != sorted(listed) or len(paged) != 4
+        or None != pages[0]['results'][0]['start']):
+        raise SyntaxError('pages with NULL starts are not what we expected: ' + str(pages))
+
+
+def test_cached_reads(database):
+    cached = database.add_user(None, 'cached@me.com', 'secret')
+    account = database.add_account(cached['id'], 'cached', 'http://bank.com/',
+                                   'usual login', 'SAVE')
+    before = database.cache_stats()['results']
+
+    if database.list_accounts(cached['id']) != database.list_accounts(cached['id']):
+        raise SyntaxError('cached accounts do not match')
+
+    after = database.cache_stats()['results']
+
+    if after['hits'] != before['hits'] + 1 or after['misses'] != before['misses'] + 1:
+        raise SyntaxError('Expected a miss then a hit but got %s then %s'%(before, after))
+
+    database.list_accounts(cached['id'])[0]['name'] = 'changed by the caller'
+    database.add_account(cached['id'], 'cached cc', 'http://bank.com/', 'usual login', 'CC')
+
+    if [x['name'] for x in database.list_accounts(cached['id'])] != ['cached', 'cached cc']:
+        raise SyntaxError('add_account did not invalidate the cache: '
+                          + str(database.list_accounts(cached['id'])))
+
+    database.point_balance(cached['id'])
+    database.user_points(cached['id'], 5, 'cached')
+
+    if database.point_balance(cached['id']) != 5 or len(database.user_points(cached['id'])) != 1:
+        raise SyntaxError('user_points did not invalidate the cache')
+
+    feedback = database.add_feedback(cached['id'], 'BUG', 'cached', 'cached votes')
+    database.feedback_tally(feedback['id'])
+    database.feedback_vote(cached['id'], feedback['id'], 3)
+
+    if database.feedback_tally(feedback['id'])['votes'] != 3:
+        raise SyntaxError('feedback_vote did not invalidate the cache')
+
+    database.list_statements(account['id'])
+    database.add_statements([(account['id'], '2020/06/01', '2020/06/30', None,
+                              0.00, 0.00, 0.00, 0.00, 10.00, 10.00)])
+
+    if len(database.list_statements(account['id'])) != 1:
+        raise SyntaxError('add_statements did not invalidate the cache')
+
+    database.net_worth(cached['id'])
+    before = database.cache_stats()['results']
+
+    if database.net_worth(cached['id'])['net_worth'] != 10.00:
+        raise SyntaxError('cached net worth is not what we expected')
+
+    if database.cache_stats()['results']['hits'] != before['hits'] + 1:
+        raise SyntaxError('net worth was not cached: ' + str(database.cache_stats()))
+
+    database.add_statement(account['id'], '2020/07/01', '2020/07/31', None,
+                           0.00, 0.00, 0.00, 0.00, 10.00, 20.00)
+
+    if database.net_worth(cached['id'])['net_worth'] != 20.00:
+        raise SyntaxError('add_statement did not invalidate the cached net worth')
+
+    for day in range(1, 1500):  # every as_of is a different result, all bounded
+        database.net_worth(cached['id'], datetime.date(2020, 1, 1)
+                           + datetime.timedelta(days=day))
+
+    if database.cache_stats()['results']['size'] > 1000:
+        raise SyntaxError('the cache outgrew its size: ' + str(database.cache_stats()))
+
+
+def test_metrics(database):
+    database.list_accounts(0)
+    database.add_statement(None, '2020/06/01', '2020/06/30', None,
+                           None, None, None, None, None, None)
+    metrics = database.metrics()
+    listed = metrics['commands']['list_accounts']['execute']
+
+    if listed['count'] < 1 or listed['buckets'][-1][1] != listed['count']:
+        raise SyntaxError('list_accounts timings are not what we expected: ' + str(listed))
+
+    if metrics['commands']['add_statement']['errors'] < 1:
+        raise SyntaxError('add_statement error was not counted: ' + str(metrics['commands']))
+
+    if metrics['commit']['count'] < 1 or metrics['queue_depth']['writes'] != 0:
+        raise SyntaxError('commit and queue metrics are not what we expected: ' + str(metrics))
+
+
+def test_session_policy(database):
+    test_db_contents(database)
+    sessions = database.metrics()['sessions']
+
+    if not sessions or [s for s in sessions.values() if s['identity_map'] or not s['recycled']]:
+        raise SyntaxError('sessions kept objects or were not recycled: ' + str(sessions))
+
+
+def test_session_growth(database):
+    # already resident in more than session_megabytes, but that is not growth
+    test_db_contents(database)
+    sessions = database.metrics()['sessions']
+
+    if not sessions or [s for s in sessions.values() if s['identity_map'] or s['recycled']]:
+        raise SyntaxError('sessions kept objects or were recycled without growing: '
+                          + str(sessions))
+
+
+def test_iterating(database):
+    myself = database.login_user('me@me.com', 'secret')
+    savings = [x for x in database.list_accounts(myself['id']) if x['type'] == 'SAVE'][0]
+    streamed = []
+
+    for statement in database.iter_statements(savings['id'], 1):
+        # reading while iterating must not wait on the iteration
+        streamed.append((statement['id'], len(database.list_accounts(myself['id']))))
+
+    if len(streamed) < 2 or set([n for _, n in streamed]) != set([4]):
+        raise SyntaxError('reads while iterating were not what we expected: '
+                          + str(streamed))
+
+    if len(list(database.iter_points(myself['id'], 1))) != len(
+            database.user_points(myself['id'])):
+        raise SyntaxError('iterated points do not match the listed points')
+
+
+# the tables as they were before any migration, without indexes or the tables kept up
+# to date alongside them
+BASELINE_SCHEMA = """
+CREATE TABLE user (id INTEGER NOT NULL, email VARCHAR(50), password_hash VARCHAR(64),
+                   birthday DATE, referrer_id INTEGER, PRIMARY KEY (id),
+                   FOREIGN KEY(referrer_id) REFERENCES user (id));
+CREATE TABLE points (id INTEGER NOT NULL, user_id INTEGER, awarded INTEGER,
+                     reason VARCHAR(1024), "when" DATETIME, PRIMARY KEY (id),
+                     FOREIGN KEY(user_id) REFERENCES user (id));
+CREATE TABLE feedback (id INTEGER NOT NULL, user_id INTEGER, type VARCHAR(32),
+                       subject VARCHAR(1024), description VARCHAR(4096), PRIMARY KEY (id),
+                       FOREIGN KEY(user_id) REFERENCES user (id));
+CREATE TABLE feedback_relationship (id INTEGER NOT NULL, from_type VARCHAR(32),
+                                    to_type VARCHAR(32), from_id INTEGER, to_id INTEGER,
+                                    PRIMARY KEY (id),
+                                    FOREIGN KEY(from_id) REFERENCES feedback (id),
+                                    FOREIGN KEY(to_id) REFERENCES feedback (id));
+CREATE TABLE feedback_votes (id INTEGER NOT NULL, user_id INTEGER, feedback_id INTEGER,
+                             votes INTEGER, PRIMARY KEY (id),
+                             FOREIGN KEY(user_id) REFERENCES user (id),
+                             FOREIGN KEY(feedback_id) REFERENCES feedback (id));
+CREATE TABLE account (id INTEGER NOT NULL, name VARCHAR(100), url VARCHAR(1024),
+                      info VARCHAR(4096), interest_rate INTEGER, type VARCHAR(5),
+                      user_id INTEGER, asset_id INTEGER, PRIMARY KEY (id),
+                      FOREIGN KEY(user_id) REFERENCES user (id),
+                      FOREIGN KEY(asset_id) REFERENCES account (id));
+CREATE TABLE statement (id INTEGER NOT NULL, start DATE, due DATE, "end" DATE,
+                        fees INTEGER, interest INTEGER, deposits INTEGER,
+                        withdrawals INTEGER, start_balance INTEGER, end_balance INTEGER,
+                        account_id INTEGER, PRIMARY KEY (id),
+                        FOREIGN KEY(account_id) REFERENCES account (id));
+"""
+
+
+def sqlite_baseline_file(path, rows):
+    """ url of a new SQLite file at path with the BASELINE_SCHEMA tables
+        rows - SQL statements filling them in
+    """
+    url = sqlite_new_file(path)
+    connection = sqlite3.connect(path)
+    connection.executescript(BASELINE_SCHEMA + rows)
+    connection.commit()
+    connection.close()
+    return url
+
+
+def test_migrate_colliding_emails(path):
+    url = sqlite_baseline_file(path, """
+        INSERT INTO user (id, email, password_hash) VALUES
+            (1, 'me@me.com', '%(secret)s'), (2, ' me@me.com', '%(secret)s'),
+            (3, 'ME@me.com', '%(secret)s'), (4, 'u@me.com', '%(secret)s');
+    """%{'secret': db.User.hash('secret')})
+
+    with db.Connect(url) as database:
+        me = database.login_user(' Me@Me.com ', 'secret')
+        added = database.add_user(None, 'me@me.com', 'secret')
+        you = database.add_user(None, 'U@me.com', 'secret')
+
+    if me['id'] != 1 or not me['valid'] or added['valid'] or you['valid']:
+        raise SyntaxError('colliding emails were not migrated as expected: %s %s %s'%(
+                          me, added, you))
+
+    found = sqlite3.connect(path).execute(
+        'SELECT id, email_normalized FROM user ORDER BY id').fetchall()
+
+    if found != [(1, 'me@me.com'), (2, None), (3, None), (4, 'u@me.com')]:
+        raise SyntaxError('normalized emails were not what we expected: ' + str(found))
+
+
+def test_migrate_baseline(path):
+    url = sqlite_baseline_file(path, """
+        INSERT INTO user (id, email, password_hash) VALUES (1, 'me@me.com', '%(secret)s'),
+                                                           (2, 'u@me.com', '%(secret)s');
+        INSERT INTO feedback (id, user_id, type, subject, description) VALUES
+            (1, 1, 'BUG', 'voted', 'voted on'), (2, 2, 'IDEA', 'unvoted', 'not voted on');
+        INSERT INTO feedback_votes (user_id, feedback_id, votes) VALUES (1, 1, 3),
+                                                                       (2, 1, 2);
+        INSERT INTO points (user_id, awarded, reason, "when") VALUES
+            (1, 5, 'old', '2020-06-01 00:00:00.000000'),
+            (1, 7, 'old', '2020-06-02 00:00:00.000000');
+        INSERT INTO account (id, name, url, info, interest_rate, type, user_id) VALUES
+            (1, 'old savings', 'http://bank.com/', 'usual login', 0, 'SAVE', 1);
+        INSERT INTO statement (start, "end", fees, interest, deposits, withdrawals,
+                               start_balance, end_balance, account_id) VALUES
+            ('2020-06-01', '2020-06-30', 0, 0, 0, 0, 10000, 12500, 1);
+    """%{'secret': db.User.hash('secret')})
+
+    with db.Connect(url) as database:
+        tallies = [database.feedback_tally(1), database.feedback_tally(2)]
+        balances = [database.point_balance(1), database.point_balance(2)]
+        worth = database.net_worth(1)['net_worth']
+        database.feedback_vote(2, 2, 4)
+        database.user_points(2, 1, 'new')
+
+    if ([(t['type'], t['votes']) for t in tallies] != [('BUG', 5), ('IDEA', 0)]
+        or balances != [12, 0] or worth != 125.00):
+        raise SyntaxError('migrated tallies, balances or statements were not what we '
+                          'expected: %s %s %s'%(tallies, balances, worth))
+
+    declared = set([i.name for t in db.Alchemy_Base.metadata.sorted_tables
+                    for i in t.indexes])
+    connection = sqlite3.connect(path)
+    indexes = set([n for n, in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")])
+    versions = connection.execute('SELECT version, applied FROM schema_version').fetchall()
+    connection.close()
+
+    if indexes != declared or [v for v, _ in versions] != [1, 2, 3, 4, 5]:
+        raise SyntaxError('migrated indexes or versions were not what we expected: '
+                          '%s %s'%(sorted(indexes), versions))
+
+    with db.Connect(url) as database:
+        tallies = [database.feedback_tally(1), database.feedback_tally(2)]
+        balances = [database.point_balance(1), database.point_balance(2)]
+
+    if [t['votes'] for t in tallies] != [5, 4] or balances != [12, 1]:
+        raise SyntaxError('reopened tallies or balances were not what we expected: '
+                          '%s %s'%(tallies, balances))
+
+    if sqlite3.connect(path).execute('SELECT version, applied FROM schema_version'
+                                     ).fetchall() != versions:
+        raise SyntaxError('migrations were applied again when reopened')
+
+
+def test_open_failure():
+    try:
+        db.Connect('sqlite:////nowhere/at/all/db.sqlite3')
+
+    except Exception:
+        return
+
+    raise SyntaxError('opening a database that can not be created did not raise')
+
 
 def test_fill_db(database):
     test_fill_db_users(database)
@@ -478,6 +1011,7 @@ def test_db_contents(database):
     test_db_contents_statements(database)
     test_db_contents_feedback(database)
     test_db_contents_points(database)
+    test_db_contents_async(database)
 
 
 def test(url):
@@ -490,6 +1024,64 @@ def test(url):
     with db.Connect(url) as database:
         test_db_contents(database)
 
+    with db.Connect(url, workers=4) as database:
+        test_db_contents(database)
+
+    with db.Connect(url, workers=2) as database:
+        test_db_contents_net_worth(database)
+
+    with db.Connect(url, workers=1) as database:
+        test_iterating(database)
+
+    with db.Connect(url, feedback_index=True) as database:
+        test_db_contents_feedback(database)
+
+    with db.Connect(url, hash_workers=4, hash_processes=True) as database:
+        test_db_contents_users(database)
+
+    with db.Connect(url, hasher=functools.partial(db.User.pbkdf2_hash, iterations=1000),
+                    hash_processes=True) as database:
+        test_salted_passwords(database)
+
+    with db.Connect(url, batch_size=32, batch_linger=0.01) as database:
+        test_batched_writes(database)
+        test_bulk_writes(database)
+        test_points_per_period(database)
+
+    with db.Connect(url, workers=2) as database:
+        test_batched_writes(database, 'workers@me.com')
+
+    with db.Connect(url, workers=2, sqlite_pragmas=db.SQLITE_PROFILE) as database:
+        test_db_contents(database)
+        test_batched_writes(database, 'wal@me.com')
+
+    if url.startswith('sqlite:///') and 'wal' != sqlite3.connect(
+            url[len('sqlite:///'):]).execute('PRAGMA journal_mode').fetchone()[0]:
+        raise SyntaxError('the SQLite profile did not switch the database to WAL')
+
+    if url.startswith('sqlite:///'):
+        test_migrate_colliding_emails(url[len('sqlite:///'):] + '.baseline')
+        test_migrate_baseline(url[len('sqlite:///'):] + '.baseline')
+
+    test_open_failure()
+
+    with db.Connect(url, workers=2, session_commands=1) as database:
+        test_session_policy(database)
+        test_batched_writes(database, 'session@me.com')
+
+    with db.Connect(url, batch_size=32, session_commands=10) as database:
+        test_session_policy(database)
+        megabytes = database.metrics()['resident_megabytes']
+
+    if megabytes:  # None without /proc
+        with db.Connect(url, workers=2, session_megabytes=megabytes / 2) as database:
+            test_session_growth(database)
+
+    with db.Connect(url, workers=2, cache_size=1000) as database:
+        test_db_contents(database)
+        test_cached_reads(database)
+        test_metrics(database)
+
 
 def sqlite_new_file(path):
     if os.path.isfile(path):
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+""" Stream bank statements from CSV or OFX files into the database
+
+    Records flow through generator stages (read, validate, transform) and are written
+    with add_statements in large batches, reading the next batch while one is written,
+    so memory stays bounded however big the file is. Progress reports the offset
+    (records of the file consumed) that has been committed, pass it back as offset to
+    resume. CSV rows before the offset are skipped as raw lines without being parsed.
+"""
+
+__all__ = ['FIELDS', 'read_csv', 'read_ofx', 'validate', 'transform', 'import_statements']
+
+
+import argparse
+import csv
+import datetime
+import itertools
+import logging
+import re
+import db
+
+FIELDS = ('account_id', 'start', 'end', 'due', 'fees', 'interest', 'deposits',
+          'withdrawals', 'start_balance', 'end_balance')
+MONEY = ('fees', 'interest', 'deposits', 'withdrawals', 'start_balance', 'end_balance')
+OPTIONAL = ('due', 'fees', 'interest', 'deposits', 'withdrawals')
+OFX_FEES = ('FEE', 'SRVCHG')
+OFX_INTEREST = ('INT', 'DIV')
+
+
+def csv_lines(lines, rows):
+    """ Generator of the raw lines of the next rows CSV rows, without parsing them
+        a row ends at the end of a line with an even number of quotes in the row (so
+        quoted fields can hold line breaks), blank lines are not rows
+    """
+    quotes = 0
+
+    while rows > 0:
+        line = next(lines, None)
+
+        if None == line:
+            return
+
+        if 0 == quotes and line in ('\n', '\r\n', '\r'):
+            continue
+
+        quotes += line.count('"')
+
+        if 0 == quotes % 2:
+            quotes = 0
+            rows -= 1
+
+        yield line
+
+
+def read_csv(lines, offset=0, columns=None):
+    """ Generator of (offset, record) for every CSV row after the first offset rows
+        lines - file (or iterable of lines) with a header row
+        columns - dict of CSV header to Statement field for headers not named as FIELDS
+        the first offset rows are skipped as raw lines, only parsed from there on
+    """
+    lines = iter(lines)
+    header = list(csv_lines(lines, 1))
+
+    for _ in csv_lines(lines, offset):
+        pass
+
+    rows = csv.DictReader(itertools.chain(header, lines))
+
+    for number, row in enumerate(rows, offset):
+        yield (number, {(columns or {}).get(k, k): v for k, v in row.items()})
+
+
+def ofx_date(text):
+    """ datetime.date of an OFX YYYYMMDD[HHMMSS[.XXX][[TZ]]] date
+    """
+    return datetime.date(int(text[0:4]), int(text[4:6]), int(text[6:8]))
+
+
+def read_ofx(lines, offset=0):
+    """ Generator of (offset, record) for every statement (STMTRS or CCSTMTRS) of an
+        OFX file (SGML or XML) after the first offset statements
+        deposits and withdrawals total the transactions, fees and interest total the
+        transactions of those types, start_balance is end_balance less all of them
+        records carry the OFX ACCTID as 'account', there is no due date
+    """
+    tag = re.compile(r'<(/?)([A-Z0-9.]+)>([^<\r\n]*)')
+    number = 0
+    record = None
+    amount = None
+    kind = None
+
+    for line in lines:
+        for closing, name, value in tag.findall(line):
+            value = value.strip()
+
+            if name in ('STMTRS', 'CCSTMTRS'):
+                if not closing:
+                    record = {'deposits': 0.0, 'withdrawals': 0.0, 'fees': 0.0,
+                              'interest': 0.0, 'net': 0.0}
+
+                elif None != record:
+                    if number >= offset:
+                        record['start_balance'] = (None if None == record.get('end_balance')
+                                                   else record['end_balance']
+                                                   - record.pop('net'))
+                        yield (number, record)
+
+                    number += 1
+                    record = None
+
+            elif None == record or closing:
+                continue
+
+            elif 'ACCTID' == name:
+                record['account'] = value
+
+            elif 'DTSTART' == name:
+                record['start'] = ofx_date(value)
+
+            elif 'DTEND' == name:
+                record['end'] = ofx_date(value)
+
+            elif 'TRNTYPE' == name:
+                kind = value
+
+            elif 'TRNAMT' == name:
+                amount = float(value)
+                record['net'] += amount
+                record['deposits' if amount > 0 else 'withdrawals'] += abs(amount)
+                record['fees'] += abs(amount) if kind in OFX_FEES else 0.0
+                record['interest'] += amount if kind in OFX_INTEREST else 0.0
+
+            elif 'BALAMT' == name and 'end_balance' not in record:  # LEDGERBAL is first
+                record['end_balance'] = float(value)
+
+
+def money(value):
+    """ Dollars of '1,234.56', '$12', '(12.00)' (negative) or a number
+    """
+    if not isinstance(value, str):
+        return float(value)
+
+    value = value.strip().replace(',', '').replace('$', '')
+
+    if value.startswith('(') and value.endswith(')'):
+        return -float(value[1:-1])
+
+    return float(value)
+
+
+def validate(records, account_id=None, accounts=None, errors=None):
+    """ Generator of (offset, record) for the records that can be imported, with
+        account_id set, dates as datetime.date and money as float dollars
+        account_id - account of every record without an account_id field
+        accounts - dict of OFX ACCTID (record 'account') to account id
+        errors - function of (offset, message) for each record skipped,
+                 None to log a warning
+    """
+    for offset, record in records:
+        try:
+            checked = {'account_id': int(record.get('account_id') or 0)
+                       or (accounts or {}).get(record.get('account')) or account_id}
+
+            if not checked['account_id']:
+                raise ValueError('no account for %s'%(record.get('account')))
+
+            for field in ('start', 'end', 'due'):
+                value = record.get(field)
+                checked[field] = (db.Date.parse(value.strip()) if isinstance(value, str)
+                                  and value.strip() else value or None)
+
+            for field in MONEY:
+                value = record.get(field)
+                blank = None == value or (isinstance(value, str) and not value.strip())
+                checked[field] = 0.0 if blank and field in OPTIONAL else money(value)
+
+            if None == checked['start'] or None == checked['end']:
+                raise ValueError('start and end dates are required')
+
+            if checked['end'] < checked['start']:
+                raise ValueError('end %s is before start %s'%(checked['end'],
+                                                              checked['start']))
+
+        except (ValueError, TypeError) as error:
+            (errors or (lambda o, m: logging.warning('skipping record %d: %s'%(o, m))))(
+                offset, str(error))
+            continue
+
+        yield (offset, checked)
+
+
+def transform(records):
+    """ Generator of (offset, add_statements row) of validated records
+    """
+    for offset, record in records:
+        yield (offset, tuple(record[f] for f in FIELDS))
+
+
+def import_statements(database, records, batch=10000, progress=None):
+    """ Write transformed records with add_statements, batch rows per transaction
+        the next batch is read while the last one is written, but only sent once the
+        last one has committed, so after a failure nothing later has been written
+        progress - function of (offset to resume from, statements imported) called as
+                   each batch commits
+        returns {'offset': to resume from, 'imported': count, 'error': None or text}
+    """
+    done = {'offset': None, 'imported': 0, 'error': None}
+    writing = None  # (future, last offset, rows) of the batch being written
+    rows = []
+
+    def finish(writing):
+        future, offset, count = writing
+        result = future.result()
+
+        if isinstance(result, tuple):
+            done['error'] = result[0]
+            return False
+
+        done['offset'] = offset + 1
+        done['imported'] += count
+
+        if progress:
+            progress(done['offset'], done['imported'])
+
+        return True
+
+    for last, row in records:
+        rows.append(row)
+
+        if len(rows) >= batch:
+            if writing and not finish(writing):
+                return done
+
+            writing = (database.add_statements_async(rows), last, len(rows))
+            rows = []
+
+    if writing and not finish(writing):
+        return done
+
+    if rows:
+        finish((database.add_statements_async(rows), last, len(rows)))
+
+    return done
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Import bank statements')
+    parser.add_argument('file', help='CSV (with a header row) or OFX file of statements')
+    parser.add_argument('-u', '--url', required=True,
+                        help='SQLAlchemy url of the database to import into')
+    parser.add_argument('-a', '--account-id', type=int, default=None,
+                        help='Account of statements that do not name one')
+    parser.add_argument('--account', action='append', default=[],
+                        help='OFX ACCTID=account id, can be repeated')
+    parser.add_argument('-f', '--format', choices=('csv', 'ofx'), default=None,
+                        help='Format of the file (default by its extension)')
+    parser.add_argument('-o', '--offset', type=int, default=0,
+                        help='Records of the file to skip, to resume an import')
+    parser.add_argument('-b', '--batch', type=int, default=10000,
+                        help='Statements to write in each transaction')
+    return parser.parse_args()
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    kind = args.format or ('ofx' if args.file.lower().endswith(('.ofx', '.qfx')) else 'csv')
+    accounts = {a.split('=')[0]: int(a.split('=')[1]) for a in args.account}
+
+    with open(args.file, newline='') as lines, db.Connect(args.url) as database:
+        records = (read_ofx(lines, args.offset) if 'ofx' == kind
+                   else read_csv(lines, args.offset))
+        done = import_statements(
+            database, transform(validate(records, args.account_id, accounts)),
+            args.batch, progress=lambda offset, imported: logging.info(
+                'imported %d statements, resume from offset %d'%(imported, offset)))
+
+    if done['error']:
+        logging.error('import stopped, resume from offset %s:\n%s'%(
+                      done['offset'] or args.offset, done['error']))
+
+    return done
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import db
+import db_test
+import io
+import logging
+import statement_import
+
+CSV = """start,end,due,fees,interest,deposits,withdrawals,start_balance,end_balance
+2020/01/01,2020/01/31,,1.00,0.50,"1,000.00",$900.00,100.00,200.00
+2020-02-01,2020-02-29,2020-03-14,,,,,200.00,200.00
+2020/03/01,not a date,,,,,,200.00,200.00
+2020/04/01,2020/04/30,,,,,(10.00),200.00,190.00
+2020/05/01,2020/05/31,,,,,,190.00,190.00
+"""
+
+OFX = """OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><CURDEF>USD
+<BANKACCTFROM><BANKID>123<ACCTID>9876<ACCTTYPE>CHECKING</BANKACCTFROM>
+<BANKTRANLIST><DTSTART>20200601<DTEND>20200630120000.000[-5:EST]
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20200605<TRNAMT>500.00</STMTTRN>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20200610<TRNAMT>-120.25</STMTTRN>
+<STMTTRN><TRNTYPE>SRVCHG<DTPOSTED>20200615<TRNAMT>-5.00</STMTTRN>
+<STMTTRN><TRNTYPE>INT<DTPOSTED>20200630<TRNAMT>0.75</STMTTRN>
+</BANKTRANLIST>
+<LEDGERBAL><BALAMT>1375.50<DTASOF>20200630</LEDGERBAL>
+<AVAILBAL><BALAMT>1300.00<DTASOF>20200630</AVAILBAL>
+</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+"""
+
+
+def test_import_csv(database, account_id):
+    skipped = []
+    progress = []
+    records = statement_import.read_csv(io.StringIO(CSV))
+    rows = statement_import.transform(statement_import.validate(
+        records, account_id, errors=lambda offset, message: skipped.append(offset)))
+    done = statement_import.import_statements(database, rows, batch=2,
+                                              progress=lambda *p: progress.append(p))
+
+    if done != {'offset': 5, 'imported': 4, 'error': None} or skipped != [2]:
+        raise SyntaxError('csv import was not what we expected: %s %s'%(done, skipped))
+
+    if progress != [(2, 2), (5, 4)]:
+        raise SyntaxError('csv import progress was not what we expected: ' + str(progress))
+
+    found = database.list_statements(account_id)
+
+    if (len(found) != 4 or found[0]['deposits'] != 1000.00 or found[0]['fees'] != 1.00
+        or found[2]['withdrawals'] != -10.00 or str(found[1]['due']) != '2020-03-14'):
+        raise SyntaxError('csv statements were not what we expected: ' + str(found))
+
+    resumed = statement_import.import_statements(database, statement_import.transform(
+        statement_import.validate(statement_import.read_csv(io.StringIO(CSV), 4),
+                                  account_id)))
+
+    if resumed != {'offset': 5, 'imported': 1, 'error': None}:
+        raise SyntaxError('resumed csv import was not what we expected: ' + str(resumed))
+
+
+def test_read_csv_resume():
+    text = ('start,end,memo\r\n2020/01/01,2020/01/31,"two\r\nlines, ""quoted"""\r\n\r\n'
+            '2020/02/01,2020/02/29,\r\n2020/03/01,2020/03/31,"""\r\n"""\r\n'
+            '2020/04/01,2020/04/30,last\r\n')
+    everything = list(statement_import.read_csv(io.StringIO(text, newline='')))
+
+    for offset in range(0, 6):
+        resumed = list(statement_import.read_csv(io.StringIO(text, newline=''), offset))
+
+        if resumed != everything[offset:]:
+            raise SyntaxError('csv resumed from %d was not what we expected: %s'%(
+                              offset, resumed))
+
+    if len(everything) != 4 or everything[0][1]['memo'] != 'two\r\nlines, "quoted"':
+        raise SyntaxError('csv with quoted line breaks was not what we expected: '
+                          + str(everything))
+
+
+def test_import_failure(database, account_id):
+    broken = CSV.replace('200.00,200.00\n2020/03/01', '200.00,1e30\n2020/03/01')
+    records = statement_import.read_csv(io.StringIO(broken))
+    done = statement_import.import_statements(database, statement_import.transform(
+        statement_import.validate(records, account_id, errors=lambda *e: None)), batch=1)
+
+    if done['offset'] != 1 or done['imported'] != 1 or not done['error']:
+        raise SyntaxError('failed csv import was not what we expected: ' + str(done))
+
+    if len(database.list_statements(account_id)) != 1:
+        raise SyntaxError('statements after the failed batch were imported: '
+                          + str(database.list_statements(account_id)))
+
+
+def test_import_ofx(database, account_id):
+    records = list(statement_import.read_ofx(io.StringIO(OFX)))
+    done = statement_import.import_statements(database, statement_import.transform(
+        statement_import.validate(records, accounts={'9876': account_id})))
+
+    if done != {'offset': 1, 'imported': 1, 'error': None}:
+        raise SyntaxError('ofx import was not what we expected: ' + str(done))
+
+    found = database.list_statements(account_id)[0]
+
+    if (str(found['start']) != '2020-06-01' or str(found['end']) != '2020-06-30'
+        or found['deposits'] != 500.75 or found['withdrawals'] != 125.25
+        or found['fees'] != 5.00 or found['interest'] != 0.75
+        or found['end_balance'] != 1375.50 or found['start_balance'] != 1000.00):
+        raise SyntaxError('ofx statement was not what we expected: ' + str(found))
+
+
+def test(url):
+    logging.basicConfig()
+    test_read_csv_resume()
+
+    with db.Connect(url) as database:
+        user = database.add_user(None, 'import@me.com', 'secret')
+        checking = database.add_account(user['id'], 'checking', 'http://bank.com/',
+                                        'usual login', 'CHECK')
+        savings = database.add_account(user['id'], 'savings', 'http://bank.com/',
+                                       'usual login', 'SAVE')
+        test_import_csv(database, checking['id'])
+        test_import_ofx(database, savings['id'])
+        broken = database.add_account(user['id'], 'broken', 'http://bank.com/',
+                                      'usual login', 'CHECK')
+        test_import_failure(database, broken['id'])
+
+
+if __name__ == '__main__':
+    test(db_test.sqlite_new_file('/tmp/statement_import.test.sqlite3'))
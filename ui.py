@@ -1,31 +1,51 @@
 #!/usr/bin/env python3
 
 import tornado.web
+import asyncio
 import argparse
 import logging
-import mako.template
+import mako.lookup
 import db
+import functools
 import os
 
+def load_templates(directory='ui', module_directory=None, check_files=False):
+    """ Compile every template in directory once, up front
+        module_directory - where to keep compiled templates between runs, None for memory only
+        check_files - recompile templates when their files change (for development)
+    """
+    templates = mako.lookup.TemplateLookup(directories=[directory],
+                                           module_directory=module_directory,
+                                           filesystem_checks=check_files)
+
+    for name in os.listdir(directory):
+        if name.endswith('.mako'):
+            templates.get_template(name)
+
+    return templates
+
+
 class MainHandler(tornado.web.RequestHandler):
-    def initialize(self, storage):
+    def initialize(self, storage, templates):
         self.__storage = storage
+        self.__templates = templates
 
     def get(self, user_id=None):
-        template = mako.template.Template(filename='ui/index.html.mako')
+        template = self.__templates.get_template('index.html.mako')
         self.write(template.render(title='Welcome to Relifi Game',
                                    logged_in=user_id))
 
 
 class LoginHandler(tornado.web.RequestHandler):
-    def initialize(self, storage):
+    def initialize(self, storage, templates):
         self.__storage = storage
+        self.__templates = templates
 
-    def get(self):
-        template = mako.template.Template(filename='ui/redirect.html.mako')
+    async def get(self):
+        template = self.__templates.get_template('redirect.html.mako')
         email = self.get_body_argument('email')
         password = self.get_body_argument('password')
-        user = self.__storage.login_user(email, password)
+        user = await asyncio.wrap_future(self.__storage.login_user_async(email, password))
 
         if not user['id']:
             self.write(template.render(title='Redirect to /', redirect='/#bademail'))
@@ -37,8 +57,97 @@ class LoginHandler(tornado.web.RequestHandler):
             self.write(template.render(title='Redirect to /user/' + str(user['id']),
                                        redirect='/user/' + str(user['id'])))
 
-    def post(self):
-        self.get()
+    async def post(self):
+        await self.get()
+
+def prometheus_histogram(lines, name, labels, histogram):
+    for bound, count in histogram['buckets']:
+        lines.append('%s_bucket{%sle="%s"} %d'%(name, labels,
+                                                 '+Inf' if bound == float('inf') else repr(bound),
+                                                 count))
+
+    labels = '{%s}'%(labels.rstrip(',')) if labels else ''
+    lines.append('%s_sum%s %r'%(name, labels, histogram['sum']))
+    lines.append('%s_count%s %d'%(name, labels, histogram['count']))
+
+
+def prometheus_text(metrics, cache):
+    """ Prometheus text exposition of db.Connect metrics() and cache_stats()
+    """
+    commands = sorted(metrics['commands'].items())
+    lines = ['# HELP game_db_command_wait_seconds Time commands waited in a queue',
+             '# TYPE game_db_command_wait_seconds histogram']
+
+    for name, command in commands:
+        prometheus_histogram(lines, 'game_db_command_wait_seconds',
+                             'command="%s",'%(name), command['wait'])
+
+    lines += ['# HELP game_db_command_execute_seconds Time commands took to execute',
+              '# TYPE game_db_command_execute_seconds histogram']
+
+    for name, command in commands:
+        prometheus_histogram(lines, 'game_db_command_execute_seconds',
+                             'command="%s",'%(name), command['execute'])
+
+    lines += ['# HELP game_db_command_errors_total Commands that failed',
+              '# TYPE game_db_command_errors_total counter']
+    lines += ['game_db_command_errors_total{command="%s"} %d'%(name, command['errors'])
+              for name, command in commands]
+    lines += ['# HELP game_db_commit_seconds Time commits took',
+              '# TYPE game_db_commit_seconds histogram']
+    prometheus_histogram(lines, 'game_db_commit_seconds', '', metrics['commit'])
+    lines += ['# HELP game_db_queue_depth Commands waiting in a queue',
+              '# TYPE game_db_queue_depth gauge']
+    lines += ['game_db_queue_depth{queue="%s"} %d'%(name, depth)
+              for name, depth in sorted(metrics['queue_depth'].items())]
+
+    lines += ['# HELP game_db_session_identity_map Objects held by a worker\'s session',
+              '# TYPE game_db_session_identity_map gauge']
+    lines += ['game_db_session_identity_map{thread="%s"} %d'%(name, session['identity_map'])
+              for name, session in sorted(metrics['sessions'].items())]
+    lines += ['# HELP game_db_session_recycled_total Sessions a worker has replaced',
+              '# TYPE game_db_session_recycled_total counter']
+    lines += ['game_db_session_recycled_total{thread="%s"} %d'%(name, session['recycled'])
+              for name, session in sorted(metrics['sessions'].items())]
+
+    if None != metrics['resident_megabytes']:
+        lines += ['# HELP process_resident_memory_bytes Resident memory size in bytes',
+                  '# TYPE process_resident_memory_bytes gauge',
+                  'process_resident_memory_bytes %d'%(metrics['resident_megabytes']
+                                                      * 1024 * 1024)]
+
+    for kind in ('hits', 'misses'):
+        lines += ['# HELP game_db_cache_%s_total Cache lookups that %s'%(
+                      kind, 'found a result' if 'hits' == kind else 'went to the database'),
+                  '# TYPE game_db_cache_%s_total counter'%(kind)]
+        lines += ['game_db_cache_%s_total{cache="%s"} %d'%(kind, name, stats[kind])
+                  for name, stats in sorted(cache.items()) if None != stats]
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, storage, templates):
+        self.__storage = storage
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(prometheus_text(self.__storage.metrics(), self.__storage.cache_stats()))
+
+
+def make_app(storage, templates):
+    """ The tornado application serving every page from storage
+        storage - db.Connect
+        templates - from load_templates
+    """
+    handler = dict(storage=storage, templates=templates)
+    return tornado.web.Application([
+        (r"/", MainHandler, handler),
+        (r"/user/(.*)", MainHandler, handler),
+        (r"/login", LoginHandler, handler),
+        (r"/metrics", MetricsHandler, handler),
+    ])
+
 
 def parse_args():
 	parser = argparse.ArgumentParser(description='Financial Game')
@@ -47,19 +156,82 @@ def parse_args():
 	parser.add_argument('-u', '--url',
 	                    default='sqlite:////%s/.game.sqlite3'%(os.environ['HOME']),
 	                    help='Port to listen on for http connections')
+	parser.add_argument('-w', '--workers', type=int, default=4,
+	                    help='Number of threads serving database reads')
+	parser.add_argument('-b', '--batch-size', type=int, default=64,
+	                    help='Most database writes to commit together')
+	parser.add_argument('-l', '--batch-linger', type=float, default=0.002,
+	                    help='Seconds to wait for more writes to commit together')
+	parser.add_argument('--hash-workers', type=int, default=2,
+	                    help='Number of threads (or processes) hashing passwords')
+	parser.add_argument('--hash-processes', action='store_true',
+	                    help='Hash passwords in processes instead of threads')
+	parser.add_argument('--password-hash', choices=('sha256', 'pbkdf2'), default='sha256',
+	                    help='Hash of new passwords, pbkdf2 is salted and slow on purpose '
+	                         '(users keep logging in with the hash they have)')
+	parser.add_argument('--pbkdf2-iterations', type=int, default=db.PBKDF2_ITERATIONS,
+	                    help='Cost of the pbkdf2 password hash')
+	parser.add_argument('--cache-size', type=int, default=0,
+	                    help='Most query results to cache in memory, 0 for no cache')
+	parser.add_argument('--cache-ttl', type=float, default=60.0,
+	                    help='Seconds to keep cached query results')
+	parser.add_argument('-s', '--sqlite-profile', action='store_true',
+	                    help='Tune SQLite for serving: WAL, synchronous=NORMAL, mmap and a '
+	                         'bigger cache (the options below override its pragmas)')
+	parser.add_argument('--sqlite-journal-mode', default=None,
+	                    help='SQLite journal_mode pragma, WAL lets reads run during writes')
+	parser.add_argument('--sqlite-synchronous', default=None,
+	                    help='SQLite synchronous pragma (OFF, NORMAL, FULL)')
+	parser.add_argument('--sqlite-mmap-size', type=int, default=None,
+	                    help='SQLite mmap_size pragma, bytes of the file to memory map')
+	parser.add_argument('--sqlite-cache-size', type=int, default=None,
+	                    help='SQLite cache_size pragma, pages or -KiB')
+	parser.add_argument('--sqlite-busy-timeout', type=int, default=None,
+	                    help='SQLite busy_timeout pragma, milliseconds to wait for locks')
+	parser.add_argument('--session-commands', type=int, default=None,
+	                    help='Start a new database session after this many commands')
+	parser.add_argument('--session-megabytes', type=int, default=None,
+	                    help='Start a new database session when memory use grew this much')
+	parser.add_argument('-t', '--template-cache', default=None,
+	                    help='Directory to keep compiled templates in between runs')
+	parser.add_argument('-r', '--template-reload', action='store_true',
+	                    help='Recompile templates when they change (for development)')
 	args = parser.parse_args()
 	return args
 
 
+def password_hasher(args):
+    if 'pbkdf2' == args.password_hash:
+        return functools.partial(db.User.pbkdf2_hash, iterations=args.pbkdf2_iterations)
+
+    return db.User.hash
+
+
+def sqlite_pragmas(args):
+    pragmas = dict(db.SQLITE_PROFILE) if args.sqlite_profile else {}
+
+    for name in ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout'):
+        if None != getattr(args, 'sqlite_' + name):
+            pragmas[name] = getattr(args, 'sqlite_' + name)
+
+    return pragmas
+
+
 def main(args):
     try:
-        with db.Connect(args.url) as storage:
+        with db.Connect(args.url, args.workers, args.batch_size, args.batch_linger,
+                        hasher=password_hasher(args),
+                        hash_workers=args.hash_workers,
+                        hash_processes=args.hash_processes,
+                        cache_size=args.cache_size,
+                        cache_ttl=args.cache_ttl,
+                        sqlite_pragmas=sqlite_pragmas(args),
+                        session_commands=args.session_commands,
+                        session_megabytes=args.session_megabytes) as storage:
             logging.basicConfig(filename='/tmp/game_log.txt',level=logging.INFO)
-            server = tornado.web.Application([
-                (r"/", MainHandler, dict(storage=storage)),
-                (r"/user/(.*)", MainHandler, dict(storage=storage)),
-                (r"/login", LoginHandler, dict(storage=storage)),
-            ])
+            templates = load_templates(module_directory=args.template_cache,
+                                       check_files=args.template_reload)
+            server = make_app(storage, templates)
             server.listen(args.port)
             tornado.ioloop.IOLoop.current().start()
     except:
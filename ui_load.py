@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+""" Load test the ui.py pages against a seeded SQLite database
+
+    Drives a weighted mix of /, /user/<id> and /login at a fixed concurrency, in
+    process (the client and server share one event loop) or against ui.py run as a
+    subprocess, then reports requests per second, latency percentiles and errors.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import tornado.httpclient
+import db
+import db_test
+import ui
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def seed(url, users):
+    """ Fill url with db_test's fixture plus users load test users
+        returns the ids of the load test users
+    """
+    with db.Connect(url) as database:
+        db_test.test_fill_db(database)
+        ids = [database.add_user(None, 'load+%d@me.com'%(n), 'secret')['id']
+               for n in range(0, users)]
+        database.flush()
+        return ids
+
+
+def requests(mix, count, user_ids, seed):
+    """ count (kind, path, body) requests chosen by the weights in mix
+    """
+    chosen = random.Random(seed)
+    kinds = sorted(mix)
+    weights = [mix[k] for k in kinds]
+
+    for _ in range(0, count):
+        kind = chosen.choices(kinds, weights)[0]
+
+        if 'index' == kind:
+            yield (kind, '/', None)
+
+        elif 'user' == kind:
+            yield (kind, '/user/%d'%(chosen.choice(user_ids)), None)
+
+        else:
+            n = chosen.randrange(0, len(user_ids))
+            password = 'secret' if chosen.random() < 0.9 else 'wrong'  # some bad logins
+            yield (kind, '/login', urllib.parse.urlencode({'email': 'load+%d@me.com'%(n),
+                                                           'password': password}))
+
+
+async def drive(base, pending, concurrency, timeout):
+    """ Send the pending requests from concurrency clients at once
+        returns {kind: [(seconds, error or None)]} and the total seconds
+    """
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    results = {}
+
+    async def worker():
+        for kind, path, body in pending:
+            started = time.perf_counter()
+            error = None
+
+            try:
+                await client.fetch(base + path, method='POST' if body else 'GET', body=body,
+                                   request_timeout=timeout)
+
+            except Exception as failed:
+                error = type(failed).__name__ + ': ' + str(failed)
+
+            results.setdefault(kind, []).append((time.perf_counter() - started, error))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(0, concurrency)])
+    return results, time.perf_counter() - started
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(results, seconds):
+    """ Requests per second, error rate and latency percentiles (milliseconds) per kind
+        of request and over all of them
+    """
+    everything = [r for kind in results.values() for r in kind]
+    summary = {}
+
+    for kind, timings in sorted(results.items()) + [('all', everything)]:
+        ordered = sorted([t for t, _ in timings])
+        errors = [e for _, e in timings if e]
+        summary[kind] = {'requests': len(timings),
+                         'requests_per_second': len(timings) / seconds,
+                         'error_rate': len(errors) / len(timings),
+                         'first_error': errors[0] if errors else None,
+                         'p50_ms': percentile(ordered, 0.50) * 1000.0,
+                         'p90_ms': percentile(ordered, 0.90) * 1000.0,
+                         'p99_ms': percentile(ordered, 0.99) * 1000.0,
+                         'max_ms': ordered[-1] * 1000.0}
+
+    return summary
+
+
+async def wait_for(base, seconds):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.monotonic() + seconds
+
+    while True:
+        try:
+            await client.fetch(base + '/')
+            return
+
+        except (ConnectionError, tornado.httpclient.HTTPClientError, OSError):
+            if time.monotonic() > deadline:
+                raise
+
+            await asyncio.sleep(0.1)
+
+
+async def run(args, user_ids):
+    base = 'http://127.0.0.1:%d'%(args.port)
+    pending = requests(args.mix, args.requests, user_ids, args.seed)
+
+    if args.subprocess:
+        server = subprocess.Popen([sys.executable, os.path.join(HERE, 'ui.py'),
+                                   '-u', args.url, '-p', str(args.port),
+                                   '-w', str(args.workers)]
+                                  + (['--sqlite-profile'] if args.sqlite_profile else []),
+                                  cwd=HERE)
+
+        try:
+            await wait_for(base, 30.0)
+            return await drive(base, pending, args.concurrency, args.timeout)
+
+        finally:
+            server.terminate()
+            server.wait()
+
+    with db.Connect(args.url, args.workers, sqlite_pragmas=db.SQLITE_PROFILE
+                    if args.sqlite_profile else None) as storage:
+        server = ui.make_app(storage, ui.load_templates(os.path.join(HERE, 'ui')))
+        listening = server.listen(args.port, '127.0.0.1')
+
+        try:
+            return await drive(base, pending, args.concurrency, args.timeout)
+
+        finally:
+            listening.stop()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def parse_mix(text):
+    """ 'index=1,user=2,login=1' to {'index': 1.0, 'user': 2.0, 'login': 1.0}
+    """
+    mix = {}
+
+    for part in text.split(','):
+        kind, weight = part.split('=')
+
+        if kind not in ('index', 'user', 'login'):
+            raise argparse.ArgumentTypeError('unknown request kind ' + kind)
+
+        mix[kind] = float(weight)
+
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the Financial Game pages')
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='Number of requests to send')
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help='Number of requests in flight at once')
+    parser.add_argument('-m', '--mix', type=parse_mix, default='index=1,user=2,login=1',
+                        help='Weights of the index, user and login requests')
+    parser.add_argument('-u', '--url', default=None,
+                        help='SQLite url to seed and serve (default a new file in /tmp)')
+    parser.add_argument('--users', type=int, default=200,
+                        help='Number of users to seed for logins')
+    parser.add_argument('-p', '--port', type=int, default=None,
+                        help='Port to serve on (default any free port)')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of threads serving database reads')
+    parser.add_argument('--sqlite-profile', action='store_true',
+                        help='Serve with db.SQLITE_PROFILE (WAL and friends)')
+    parser.add_argument('-s', '--subprocess', action='store_true',
+                        help='Run ui.py in its own process instead of in this one')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Seconds before a request counts as failed')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the request mix')
+    parser.add_argument('-o', '--output', default=None,
+                        help='File to append the results to as a line of JSON')
+    return parser.parse_args()
+
+
+def main(args):
+    args.url = args.url or db_test.sqlite_new_file('/tmp/ui.load.sqlite3')
+    args.port = args.port or free_port()
+    results, seconds = asyncio.run(run(args, seed(args.url, args.users)))
+    summary = summarize(results, seconds)
+
+    for kind, stats in summary.items():
+        print('%-6s %7d requests %9.1f/s  errors %6.2f%%  p50 %8.3fms  p90 %8.3fms  '
+              'p99 %8.3fms'%(kind, stats['requests'], stats['requests_per_second'],
+                             stats['error_rate'] * 100.0, stats['p50_ms'],
+                             stats['p90_ms'], stats['p99_ms']))
+
+    if args.output:
+        with open(args.output, 'a') as output:
+            output.write(json.dumps({'when': datetime.datetime.now().isoformat(),
+                                     'requests': args.requests,
+                                     'concurrency': args.concurrency,
+                                     'mix': args.mix, 'workers': args.workers,
+                                     'subprocess': args.subprocess,
+                                     'sqlite_profile': args.sqlite_profile,
+                                     'seconds': seconds, 'results': summary}) + '\n')
+
+
+if __name__ == '__main__':
+    main(parse_args())